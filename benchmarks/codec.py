@@ -0,0 +1,56 @@
+"""Compares the serialization throughput of the installed JSON libraries on
+collections shaped like the ones LazyManager stores.
+
+Usage:
+    python benchmarks/codec.py [entries]
+"""
+
+import os, random, sys, time, uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rest_api_helper import JsonCodec
+
+
+def make_collections(count):
+    readings = {}
+    for i in range(count):
+        readings[str(i)] = {'id': str(i), '__id__': str(uuid.uuid4()),
+            'value': random.uniform(-20, 45), 'location': 'room-%d' % (i % 50),
+            'timestamp': 1500000000 + i}
+
+    profiles = {}
+    for i in range(count / 10):
+        profiles[i] = {'id': i, '__id__': str(uuid.uuid4()),
+            'name': u'user %d \xe9' % i, 'tags': ['a', 'b', 'c'][:i % 4],
+            'settings': {'theme': 'dark', 'alerts': i % 2 == 0, 
+                         'limits': [10, 20, 30]}}
+
+    return [('readings', readings), ('profiles', profiles)]
+
+def measure(function, argument, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function(argument)
+        elapsed = time.time() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    codecs = JsonCodec.available()
+
+    print '%-10s %-10s %10s %10s %10s' % ('data', 'codec', 'MB', 
+                                          'dumps MB/s', 'loads MB/s')
+    for label, data in make_collections(count):
+        for codec in codecs:
+            text = codec.dumps(data)
+            size = len(text) / 1e6
+            dumps = measure(codec.dumps, data, 3)
+            loads = measure(codec.loads, text, 3)
+            print '%-10s %-10s %10.1f %10.1f %10.1f' % (label, codec.name, 
+                size, size / dumps, size / loads)
+
+if __name__ == '__main__':
+    main()
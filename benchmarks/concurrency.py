@@ -0,0 +1,82 @@
+"""Measures read throughput of LazyManager while other threads write to the
+same collection.
+
+Usage:
+    python benchmarks/concurrency.py [entries] [seconds]
+"""
+
+import json, os, random, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+from rest_api_helper import LazyManager, CollectionConfig, DataHelper
+
+
+def make_request(path, method='GET', body=None):
+    builder = EnvironBuilder(path=path, method=method, data=body)
+    return Request(builder.get_environ())
+
+def populate(count):
+    records = LazyManager.records
+    ids = []
+    for i in range(count):
+        DataHelper.add_entry(records, 'bench', {'id': i, 'value': i % 100})
+        ids.append(records['bench'][i]['__id__'])
+    return ids
+
+def run(manager, ids, readers, writers, seconds):
+    stop = threading.Event()
+    counts = [0] * (readers + writers)
+
+    def read(slot):
+        while not stop.is_set():
+            entry_id = random.choice(ids)
+            req = make_request('/api/bench/' + entry_id)
+            manager.get_data_entries(req, 'bench', entry_id)
+            counts[slot] += 1
+
+    def write(slot):
+        while not stop.is_set():
+            i = random.randrange(len(ids))
+            body = json.dumps({'id': i, 'value': random.randrange(100)})
+            req = make_request('/api/bench/' + ids[i], 'PUT', body)
+            manager.update_data_entry(req, 'bench', ids[i])
+            counts[slot] += 1
+
+    threads = [threading.Thread(target=read, args=(n,)) 
+        for n in range(readers)]
+    threads += [threading.Thread(target=write, args=(readers + n,)) 
+        for n in range(writers)]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts[:readers]) / seconds, sum(counts[readers:]) / seconds
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+
+    data_dir = tempfile.mkdtemp()
+    LazyManager.init([CollectionConfig('bench', 'id', 
+                                       os.path.join(data_dir, 'bench.json'))])
+    manager = LazyManager()
+    ids = populate(count)
+
+    print '%d entries, %.1fs per run' % (count, seconds)
+    print '%8s %8s %14s %14s' % ('readers', 'writers', 'reads/s', 'writes/s')
+    for readers, writers in [(4, 0), (4, 1), (4, 4), (8, 4)]:
+        reads, writes = run(manager, ids, readers, writers, seconds)
+        print '%8d %8d %14.0f %14.0f' % (readers, writers, reads, writes)
+
+    LazyManager.dirty.clear()                       # skip the atexit save
+
+if __name__ == '__main__':
+    main()
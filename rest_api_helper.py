@@ -21,12 +21,28 @@
 # SOFTWARE.
 
 from flask import Flask, Response, request
-import json, os, pprint, uuid, inspect, threading, atexit
+import json, os, uuid, inspect, threading, atexit, time, shutil, calendar, zlib
+import base64, bisect, collections, itertools, contextlib, cPickle, mmap
+import multiprocessing, logging
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 from flask import make_response, request, current_app
 from functools import update_wrapper
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Silent unless the application configures logging; see logging.basicConfig
+logger = logging.getLogger('rest_api_helper')
+logger.addHandler(logging.NullHandler())
+
 
 class Util:
 
@@ -92,8 +108,97 @@ class Util:
       info = inspect.getframeinfo(frame)
       print info.filename, ':', info.lineno, '-', info.function 
 
+class JsonCodec:
+    """JSON encoder/decoder pair backed by one of the supported JSON libraries.
+    The fastest installed library is used for serializing collections, journal
+    records and HTTP bodies; the stdlib json module is the fallback.
+
+    simplejson (with its C speedups) decodes several times faster than the 
+    stdlib json module on Python 2, but encodes non-ASCII text slower, so its
+    codec decodes with simplejson and encodes with json. ujson 1.x is not 
+    used as it rounds floats and drops lone surrogates.
+
+    The REST_API_HELPER_JSON environment variable forces a specific library
+    (json or simplejson).
+    """
+
+    PREFERENCE = ('simplejson', 'json')
+
+    def __init__(self, name, dumps, loads):
+        """Defines a new codec
+
+        Args:
+            name: name of the backing library
+            dumps: function serializing an object to a JSON string
+            loads: function parsing a JSON string; raises ValueError on 
+                invalid input
+
+        Returns:
+            None
+        """
+
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    @staticmethod
+    def create(name):
+        """Creates the codec backed by the named library.
+
+        Args:
+            name: library name, one of PREFERENCE
+
+        Returns:
+            codec; None if the library is not installed
+        """
+
+        try:
+            module = __import__(name)
+        except ImportError:
+            return None
+
+        if name == 'simplejson':
+            try:
+                __import__('simplejson._speedups')
+            except ImportError:
+                return None                     # slower than json without them
+
+            # Newer releases reject NaN and Infinity unless asked, unlike json
+            try:
+                module.loads('NaN', allow_nan=True)
+            except TypeError:
+                return JsonCodec(name, json.dumps, module.loads)
+
+            return JsonCodec(name, json.dumps, 
+                             lambda text: module.loads(text, allow_nan=True))
+
+        return JsonCodec(name, module.dumps, module.loads)
+
+    @staticmethod
+    def available():
+        """Returns the codecs of all installed libraries, fastest first."""
+        codecs = [JsonCodec.create(name) for name in JsonCodec.PREFERENCE]
+        return [c for c in codecs if c != None]
+
+    @staticmethod
+    def select(name=None):
+        """Returns the codec backed by the named library, or by the fastest
+        installed library if name is None or the library is not installed.
+        """
+
+        if name != None:
+            codec = JsonCodec.create(name)
+            if codec != None:
+                return codec
+
+        return JsonCodec.available()[0]
+
 class CollectionConfig:
-    def __init__(self, name, id_field, data_file):
+    def __init__(self, name, id_field, data_file, journal_file=None,
+                 compact_every=10000, snapshot_interval=None, 
+                 snapshot_max_dirty=None, fsync='on-snapshot', stream=False,
+                 filter_fields=None, indexes=None, storage_format='json',
+                 lazy=False, evict_after=None, shards=1, backend=None):
         """Defines a new collection config
 
         Args:
@@ -103,24 +208,156 @@ class CollectionConfig:
                 all the entries of the collection
             data_file: path to the data file that would store the collection 
                 entries
+            journal_file: optional path to an append-only journal that records
+                every add/update/delete; replayed on top of the data file when
+                the collection is loaded
+            compact_every: number of journal records after which the journal is
+                compacted into the data file
+            snapshot_interval: seconds between background snapshots of the 
+                collection; only taken if the collection has changed
+            snapshot_max_dirty: number of unsaved mutations that triggers an
+                immediate background snapshot
+            fsync: durability policy; 'never' leaves flushing to the OS,
+                'on-snapshot' fsyncs data files as they are saved and 'always'
+                additionally fsyncs every journal record
+            stream: if True, full-collection reads are sent as a chunked 
+                stream instead of a single serialized body
+            filter_fields: fields that clients may filter full-collection 
+                reads by, e.g. ?location=kitchen
+            indexes: dictionary of field name to index kind, 'hash' for 
+                equality filters or 'sorted' for equality and range queries;
+                indexed fields may be filtered by without being listed in 
+                filter_fields, and filters on them avoid scanning the 
+                collection
+            storage_format: format of the data file; 'json', or the compact
+                binary 'msgpack' (requires the msgpack package) or 'pickle'
+                formats, which load and save faster, or 'jsonl', one entry 
+                per line
+            lazy: if True, the data file ('jsonl' format) is memory-mapped and
+                entries are decoded on first access instead of at startup;
+                declared field indexes still decode every entry at startup
+            evict_after: for lazy collections, seconds without access after
+                which decoded entries are dropped from memory
+            shards: number of files the collection is hash-partitioned into 
+                by ID; each shard has its own data file and journal (e.g. 
+                data.0.json and data.0.log for data.json and data.log) and 
+                is only rewritten when its entries change. Atomic batches
+                are not supported on sharded collections. The shard count of
+                an existing collection cannot be changed in place, and an
+                existing unsharded data file is rejected rather than ignored
+            backend: optional StorageBackend (e.g. SqliteBackend) storing 
+                the collection in place of the data file and journal, so 
+                that several processes can serve it; the data file, if 
+                present, is imported on first use
 
         Returns:
             None
         """        
 
+        if fsync not in ('never', 'on-snapshot', 'always'):
+            raise ValueError('unknown fsync policy: %s' % fsync)
+
+        if storage_format not in ('json', 'jsonl', 'msgpack', 'pickle'):
+            raise ValueError('unknown storage format: %s' % storage_format)
+        if lazy and storage_format != 'jsonl':
+            raise ValueError('lazy collections require the jsonl format')
+        if storage_format == 'msgpack' and msgpack == None:
+            raise ValueError('msgpack storage format requires msgpack')
+        if not isinstance(shards, (int, long)) or shards < 1:
+            raise ValueError('invalid shard count: %r' % (shards,))
+        if lazy and shards > 1:
+            raise ValueError('lazy collections cannot be sharded')
+        if backend != None and (lazy or shards > 1 or journal_file != None):
+            raise ValueError('collections with a storage backend cannot be '
+                             'lazy, sharded or journaled')
+
         self.name = name
         self.id_field = id_field
         self.data_file = data_file 
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_max_dirty = snapshot_max_dirty
+        self.fsync = fsync
+        self.stream = stream
+        self.filter_fields = filter_fields
+        self.indexes = indexes
+        self.storage_format = storage_format
+        self.lazy = lazy
+        self.evict_after = evict_after
+        self.shards = shards
+        self.backend = backend
+
+        if shards == 1:
+            self.data_files = [data_file]
+            self.journal_files = [journal_file]
+        else:
+            self.data_files = [CollectionConfig.shard_path(data_file, shard)
+                               for shard in range(shards)]
+            self.journal_files = [None if journal_file == None else
+                                  CollectionConfig.shard_path(journal_file, shard)
+                                  for shard in range(shards)]
+
+            if os.path.isfile(data_file) and os.path.getsize(data_file) > 0 \
+                    and not any(os.path.isfile(f) for f in self.data_files):
+                raise ValueError('%s holds the unsharded collection %s; split '
+                                 'it into shard files first' % (data_file, name))
+
+        for field, kind in (indexes or {}).iteritems():
+            if kind not in ('hash', 'sorted'):
+                raise ValueError('unknown index kind for %s: %s' % (field, kind))
+
+    @staticmethod
+    def shard_path(path, shard):
+        """Returns the path of a shard file, e.g. data.2.json for data.json"""
+        base, ext = os.path.splitext(path)
+        return '%s.%d%s' % (base, shard, ext)
 
 class DataHelper:
 
+    codec = JsonCodec.select(os.environ.get('REST_API_HELPER_JSON'))
+
+    FSYNC_NEVER = 'never'               # leave flushing to the OS
+    FSYNC_ON_SNAPSHOT = 'on-snapshot'   # fsync data files when snapshotting
+    FSYNC_ALWAYS = 'always'             # also fsync every journal record
+
+    STORAGE_FORMATS = ('json', 'jsonl', 'msgpack', 'pickle')
+
+    @staticmethod
+    def check_entry(entry, id_field):
+        """Checks that an entry can be stored: it must be a dictionary with
+        a scalar ID field value and, if given, a string internal ID.
+
+        Args:
+            entry: entry to check
+            id_field: ID field of the collection
+
+        Returns:
+            error message; None if the entry is valid
+        """
+
+        if not isinstance(entry, dict):
+            return 'invalid entry'
+        if not entry.has_key(id_field):
+            return 'missing ' + id_field
+        if isinstance(entry[id_field], (list, dict)):
+            return 'invalid ' + id_field
+        if entry.has_key('__id__') and \
+                not isinstance(entry['__id__'], basestring):
+            return 'invalid __id__'
+        return None
+
     @staticmethod
     def add_entry(records, collection, entry):
 
         logical_id_field = LazyManager.collection_configs[collection].id_field
-        if not entry.has_key(logical_id_field):
+        if not isinstance(entry, dict) or not entry.has_key(logical_id_field):
             return 400, str('')
 
+        error = DataHelper.check_entry(entry, logical_id_field)
+        if error != None:
+            return 400, DataHelper.codec.dumps({'error': error})
+
         id_value = entry[logical_id_field]
 
         if entry.has_key('__id__') and len(entry['__id__']) > 0:
@@ -128,7 +365,34 @@ class DataHelper:
         else:
             entry['__id__'] = str(uuid.uuid4())
 
-        entries = records[collection]
+        with LazyManager.writing(collection):
+            old_entry = DataHelper.store_entry(records[collection], collection, 
+                                               id_value, entry)
+            if old_entry == False:
+                return 400, '{"error": "non matching IDs"}'
+
+            LazyManager.log_operation(collection, 'put', id_value, entry)
+
+        return 200, DataHelper.codec.dumps(entry)
+
+    @staticmethod
+    def store_entry(entries, collection, id_value, entry):
+        """Stores an entry that already has its __id__ under the specified 
+        logical key, keeping the indexes up to date. The caller must hold the
+        write lock of the collection and log the operation.
+
+        Args:
+            entries: dictionary of entries of the collection
+            collection: collection name
+            id_value: logical key (value of the id_field) of the entry
+            entry: entry to store
+
+        Returns:
+            the replaced entry; None if the entry is new; False if the entry
+            conflicts with the stored one
+        """
+
+        old_entry = None
         
         if entries.has_key(id_value):
 
@@ -137,22 +401,292 @@ class DataHelper:
             # Must validate against existing entry.
             # Check if the old and new entry has the same internal ID
             if not old_entry['__id__'] == entry['__id__']:
-                return 400, '{"error": "non matching IDs"}'
+                return False
 
         entries[id_value] = entry    
+        LazyManager.index_entry(collection, entry['__id__'], id_value)
+        LazyManager.update_field_indexes(collection, id_value, old_entry, entry)
+
+        return old_entry
+
+    @staticmethod
+    def add_entries(records, collection, entries, atomic=False):
+        """Adds or updates a list of entries in one pass. Entries are validated
+        up front, missing internal IDs are generated together, and all entries
+        are stored under a single acquisition of the write lock and journaled
+        in a single write.
+
+        Args:
+            records: dictionary of collections
+            collection: collection name
+            entries: list of entries
+            atomic: if True, either all entries are stored or, if any of them
+                is rejected, none are; the batch is journaled as one record.
+                Not supported on sharded collections
+
+        Returns:
+            list of (status, result) tuples, one per entry, where result is the
+            stored entry or an error dictionary; status is 201 for added 
+            entries, 200 for updated ones and 400 for rejected ones. In an
+            atomic batch that was rejected, the valid entries get 424.
+
+        Raises:
+            ValueError: atomic is set for a sharded collection
+        """
+
+        config = LazyManager.collection_configs[collection]
+        if atomic and config.shards > 1:
+            raise ValueError('atomic batches are not supported on sharded '
+                             'collection %s' % collection)
+
+        logical_id_field = config.id_field
+
+        results = [None] * len(entries)
+        valid = []
+        for i, entry in enumerate(entries):
+            error = DataHelper.check_entry(entry, logical_id_field)
+            if error != None:
+                results[i] = (400, {'error': error})
+            else:
+                valid.append(i)
+
+        missing = [i for i in valid
+            if not (entries[i].has_key('__id__') and len(entries[i]['__id__']) > 0)]
+        for i, internal_id in zip(missing, DataHelper.generate_ids(len(missing))):
+            entries[i]['__id__'] = internal_id
+
+        if atomic and len(valid) < len(entries):
+            return DataHelper.reject_batch(results)
+
+        operations = []
+        with LazyManager.writing(collection):
+            stored = records[collection]
+
+            if atomic:
+                # Check every entry against the stored ones, and against the
+                # earlier entries of the batch, before changing anything
+                pending = {}
+                rejected = False
+                for i in valid:
+                    entry = entries[i]
+                    id_value = entry[logical_id_field]
+                    current = pending.get(id_value, stored.get(id_value))
+                    if current != None and current['__id__'] != entry['__id__']:
+                        results[i] = (400, {'error': 'non matching IDs'})
+                        rejected = True
+                    pending[id_value] = entry
+
+                if rejected:
+                    return DataHelper.reject_batch(results)
+
+            for i in valid:
+                entry = entries[i]
+                id_value = entry[logical_id_field]
+
+                old_entry = DataHelper.store_entry(stored, collection, 
+                                                   id_value, entry)
+                if old_entry == False:
+                    results[i] = (400, {'error': 'non matching IDs'})
+                    continue
+
+                results[i] = (201 if old_entry == None else 200, entry)
+                operations.append(('put', id_value, entry))
+
+            LazyManager.log_operations(collection, operations, atomic)
+
+        return results
+
+    @staticmethod
+    def reject_batch(results):
+        return [(424, {'error': 'batch rejected'}) if result == None else result
+            for result in results]
+
+    @staticmethod
+    def generate_ids(count):
+        """Generates random (version 4) UUID strings from a single read of the
+        system's random source.
+        """
+
+        raw = os.urandom(16 * count)
+        return [str(uuid.UUID(bytes=raw[i:i + 16], version=4)) 
+            for i in xrange(0, 16 * count, 16)]
+
+    @staticmethod
+    def matches(actual, expected):
+        """Compares a stored field value with a value taken from the URL. 
+        Non-string values are compared using their JSON representation, so 
+        that e.g. 30 matches '30' and True matches 'true'.
+        """
+
+        if isinstance(actual, basestring):
+            return actual == expected
+
+        return json.dumps(actual) == expected
+
+    @staticmethod
+    def parse_value(text):
+        """Reads a value taken from the URL as JSON if possible, so that '30'
+        becomes a number; otherwise keeps it as text.
+        """
+
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+
+    @staticmethod
+    def compare(actual, op, operand):
+        """Evaluates a single filter operation against a stored field value.
+        Ordering operations only match values of the same kind as the operand
+        (numbers with numbers, strings with strings).
+
+        Args:
+            actual: stored field value
+            op: 'eq', 'in', 'gt', 'gte', 'lt', 'lte' or 'between'
+            operand: text for 'eq'; list of texts for 'in'; parsed value for
+                the others, a pair of them for 'between'
+
+        Returns:
+            True if the value satisfies the operation; otherwise, false
+        """
+
+        if op == 'eq':
+            return DataHelper.matches(actual, operand)
+        if op == 'in':
+            return any(DataHelper.matches(actual, text) for text in operand)
+
+        bounds = operand if op == 'between' else (operand,)
+        for bound in bounds:
+            if not DataHelper.comparable(actual, bound):
+                return False
+
+        if op == 'gt':
+            return actual > operand
+        if op == 'gte':
+            return actual >= operand
+        if op == 'lt':
+            return actual < operand
+        if op == 'lte':
+            return actual <= operand
+        if op == 'between':
+            return operand[0] <= actual <= operand[1]
+        return False
+
+    @staticmethod
+    def comparable(a, b):
+        numbers = (int, long, float)
+        if isinstance(a, numbers) and isinstance(b, numbers):
+            return not isinstance(a, bool) and not isinstance(b, bool)
+
+        return isinstance(a, basestring) and isinstance(b, basestring)
+
+    @staticmethod
+    def project(entry, fields):
+        """Returns a new dictionary holding only the specified fields of an 
+        entry; the entry itself if fields is None.
+        """
+
+        if fields == None:
+            return entry
+
+        return {f: entry[f] for f in fields if f in entry}
+
+    @staticmethod
+    def project_all(entries, fields):
+        """Projects every entry of a dictionary of entries, preserving the 
+        order of the keys.
+        """
+
+        if fields == None:
+            return entries
+
+        projected = collections.OrderedDict()
+        for key, entry in entries.iteritems():
+            projected[key] = DataHelper.project(entry, fields)
+
+        return projected
+
+    @staticmethod
+    def iter_json(entries, chunk_size=65536, fields=None):
+        """Serializes a dictionary of entries as a JSON object, one chunk at a
+        time, so that large collections can be sent without building the 
+        whole document in memory.
+
+        Args:
+            entries: dictionary of entries
+            chunk_size: approximate size in characters of each yielded chunk
+            fields: optional list of fields to keep in each entry
+
+        Returns:
+            generator of JSON text chunks
+        """
+
+        # Take the items now, not on first iteration, so the stream reflects
+        # the collection as it was when the response was created
+        return DataHelper.iter_json_items(entries.items(), chunk_size, fields)
+
+    @staticmethod
+    def iter_json_items(items, chunk_size=65536, fields=None):
+        parts = ['{']
+        size = 1
+        separator = ''
+        for key, entry in items:
+            entry = DataHelper.project(entry, fields)
+            if not isinstance(key, basestring):
+                key = json.dumps(key)           # object keys must be strings
+            part = separator + json.dumps(key) + ': ' + \
+                DataHelper.codec.dumps(entry)
+            parts.append(part)
+            size += len(part)
+            separator = ', '
+
+            if size >= chunk_size:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+
+        parts.append('}')
+        yield ''.join(parts)
+
+    @staticmethod
+    def shard_of(key, shards):
+        """Returns the shard holding the specified logical key. A key maps to
+        the same shard whether it was read from a data file or a request.
+
+        Args:
+            key: logical key (ID field value) of an entry
+            shards: number of shards of the collection
+
+        Returns:
+            shard number, from 0 to shards - 1
+        """
 
-        return 200, json.dumps(entry)
+        if shards == 1:
+            return 0
+
+        text = HashIndex.text(key)
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return (zlib.crc32(text) & 0xffffffff) % shards
 
     @staticmethod
-    def load_data(path):
-        """Loads the contents of the specified collection data file as JSON. If 
-        the data file is not found, this method will attempt to create it.
+    def load_data(path, journal_path=None, storage_format='json'):
+        """Loads the contents of the specified collection data file. If the 
+        data file is not found, this method will attempt to create it.
 
         Args:
             path: data file path
+            journal_path: optional journal file path; its records are replayed
+                on top of the loaded entries
+            storage_format: format of the data file, see STORAGE_FORMATS
 
         Returns:
             list of collection entries loaded
+
+        Raises:
+            ValueError: if the data file is not empty but cannot be decoded;
+                it is left untouched rather than treated as an empty 
+                collection that the next save would overwrite
         """
 
         if not os.path.isfile(path):            # Create file if file not found
@@ -164,155 +698,2272 @@ class DataHelper:
 
             open(path, 'a').close()             # Create the file
 
-        entries = []
-        with open(path, 'r') as data_file:
+        with open(path, 'rb') as data_file:
             try:
-                entries = json.load(data_file)
-            except ValueError:
-                entries = {}
+                entries = DataHelper.decode_data(data_file.read(), 
+                                                 storage_format)
+            except ValueError as e:
+                logger.error('cannot decode data file %s: %s', path, e)
+                raise ValueError('cannot decode data file %s: %s' % (path, e))
+
+        if journal_path != None:
+            DataHelper.replay_journal(journal_path + '.1', entries, 
+                                      storage_format)
+            DataHelper.replay_journal(journal_path, entries, storage_format)
 
-        pprint.pprint(entries)
         return entries
 
     @staticmethod
-    def save_data(path, data):
-        """Saves specified collection as JSON contents in a data file.
+    def replay_journal(path, entries, storage_format=None):
+        """Applies the records of the specified journal file to the entries.
+        A trailing record left incomplete by a crash is ignored.
+
+        Args:
+            path: journal file path
+            entries: dictionary of entries to update in place
+            storage_format: format of the data file the entries were loaded 
+                from; journal keys are converted to the form that format 
+                stores keys in, so a journaled key matches its loaded entry
+
+        Returns:
+            number of records applied
+        """
+
+        if not os.path.isfile(path):
+            return 0
+
+        count = 0
+        with open(path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = DataHelper.codec.loads(line)
+                except ValueError:
+                    break                       # torn write at the tail
+
+                batch = record['ops'] if record['op'] == 'batch' else [record]
+                for record in batch:
+                    key = DataHelper.stored_key(record['key'], storage_format)
+                    if record['op'] == 'put':
+                        entries[key] = record['entry']
+                    elif record['op'] == 'del':
+                        entries.pop(key, None)
+                count += 1
+
+        return count
+
+    @staticmethod
+    def stored_key(key, storage_format):
+        """Returns a logical key as a data file of the specified format would
+        load it back; 'json' data files hold every key as a string.
+
+        Args:
+            key: logical key (ID field value) of an entry
+            storage_format: format of the data file, see STORAGE_FORMATS
+
+        Returns:
+            key as loaded from the data file
+        """
+
+        if storage_format != 'json' or isinstance(key, basestring):
+            return key
+        return unicode(json.dumps(key))
+
+    @staticmethod
+    def append_journal(journal_file, operations, fsync=False, atomic=False):
+        """Appends operation records to an open journal file, one per line.
+
+        Args:
+            journal_file: file object opened for appending
+            operations: list of (op, key, entry) tuples, where op is 'put' or
+                'del', key is the logical key (value of the id_field) of the
+                entry and entry is the stored entry for 'put' records
+            fsync: if True, force the records to disk before returning
+            atomic: if True, write all operations as a single 'batch' record
+
+        Returns:
+            None
+        """
+
+        records = []
+        for op, key, entry in operations:
+            record = {'op': op, 'key': key}
+            if entry != None:
+                record['entry'] = entry
+            records.append(record)
+
+        if atomic:
+            records = [{'op': 'batch', 'ops': records}]
+
+        dumps = DataHelper.codec.dumps
+        journal_file.write(''.join(dumps(r) + '\n' for r in records))
+        journal_file.flush()
+        if fsync:
+            os.fsync(journal_file.fileno())
+
+    @staticmethod
+    def save_data(path, data, fsync=False, storage_format='json'):
+        """Saves specified collection in a data file.
+
+        The contents are written to a temporary file next to the data file and
+        then renamed over it, so the previous data file stays intact until the
+        new one is complete.
 
         Args:
             path: data file path
+            data: collection entries to save
+            fsync: if True, flush the new file and its directory to disk 
+                before returning
+            storage_format: format of the data file, see STORAGE_FORMATS
 
         Returns:
             True on success; otherwise, false
         """
 
-        if not os.path.isfile(path):            # Create file if file not found
+        # Create necessary parent directories
+        basedir = os.path.dirname(path)
+        if len(basedir) > 0 and not os.path.exists(basedir):
+            os.makedirs(basedir)                # Create parent directories
+
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as data_file:
+                data_file.write(DataHelper.encode_data(data, storage_format))
+                if fsync:
+                    data_file.flush()
+                    os.fsync(data_file.fileno())
+        except (ValueError, TypeError, OverflowError, IOError, OSError,
+                cPickle.PicklingError):
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        try:
+            if os.name == 'nt' and os.path.isfile(path):
+                os.remove(path)                 # rename won't replace on Windows
+            os.rename(tmp_path, path)
+        except OSError:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        if fsync:
+            DataHelper.fsync_dir(basedir)
 
-            # Create necessary parent directories
-            basedir = os.path.dirname(path)
-            if len(basedir) > 0 and not os.path.exists(basedir):
-                os.makedirs(basedir)            # Create parent directories
+        return True
+
+    @staticmethod
+    def encode_data(data, storage_format):
+        """Serializes collection entries in the specified storage format.
+
+        Args:
+            data: collection entries
+            storage_format: one of STORAGE_FORMATS
+
+        Returns:
+            serialized bytes
+        """
+
+        if storage_format == 'pickle':
+            return cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+
+        if storage_format == 'msgpack':
+            return msgpack.packb(data, use_bin_type=True)
+
+        if storage_format == 'jsonl':
+            return ''.join(''.join(LazyEntries.encode_line(k, e)) + '\n'
+                for k, e in data.iteritems())
+
+        text = DataHelper.codec.dumps(data)
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+    @staticmethod
+    def decode_data(raw, storage_format):
+        """Parses collection entries serialized in the specified storage 
+        format. Empty contents decode to an empty collection.
+
+        Args:
+            raw: serialized bytes
+            storage_format: one of STORAGE_FORMATS
+
+        Returns:
+            collection entries
+
+        Raises:
+            ValueError: if the contents are not valid
+        """
+
+        if len(raw) == 0:
+            return {}
+
+        if storage_format == 'pickle':
+            try:
+                return cPickle.loads(raw)
+            except (cPickle.UnpicklingError, EOFError, IndexError) as e:
+                raise ValueError(str(e))
+
+        if storage_format == 'msgpack':
+            options = {'raw': False}
+            if msgpack.version >= (1, 0):
+                options['strict_map_key'] = False   # allow numeric keys
+            try:
+                return msgpack.unpackb(raw, **options)
+            except Exception as e:
+                raise ValueError(str(e))
+
+        if storage_format == 'jsonl':
+            entries = {}
+            for line in raw.splitlines():
+                parts = line.split('\t', 2)
+                if len(parts) == 3:
+                    entries[json.loads(parts[0])] = \
+                        DataHelper.codec.loads(parts[2])
+            return entries
+
+        return DataHelper.codec.loads(raw)
+
+    @staticmethod
+    def convert_data(source_path, source_format, target_path, target_format):
+        """Converts a collection data file from one storage format to another,
+        e.g. to migrate an existing JSON data file to msgpack.
+
+        Args:
+            source_path: path of the data file to read
+            source_format: format of the source file, see STORAGE_FORMATS
+            target_path: path of the data file to write
+            target_format: format of the target file, see STORAGE_FORMATS
+
+        Returns:
+            True on success; otherwise, false
+        """
+
+        with open(source_path, 'rb') as data_file:
+            entries = DataHelper.decode_data(data_file.read(), source_format)
+
+        return DataHelper.save_data(target_path, entries, True, target_format)
+
+    @staticmethod
+    def fsync_dir(path):
+        """Flushes a directory entry to disk so a rename within it is durable.
+        Not supported on all platforms; failures are ignored.
+        """
+
+        if os.name == 'nt':
+            return
+
+        try:
+            fd = os.open(path if len(path) > 0 else '.', os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def load_collection_data(args):
+    """Loads a collection data file on behalf of a loader process. Lives at
+    module level so that it can be pickled by multiprocessing.
+
+    Args:
+        args: tuple of (data file path, journal file path, storage format)
+
+    Returns:
+        tuple of (loaded entries, seconds spent loading)
+    """
+
+    started = time.time()
+    entries = DataHelper.load_data(*args)
+    return entries, time.time() - started
+
+class ReadWriteLock:
+    """Lock that lets any number of readers in at once while giving writers
+    exclusive access. Waiting writers take precedence over new readers so
+    a steady stream of reads cannot starve them.
+
+    A writer may re-acquire the lock for writing or reading; readers must not
+    re-acquire it, as a waiting writer would then deadlock them.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.write_depth = 0
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.write_depth += 1
+                return
+
+            while self.writer != None or self.writers_waiting > 0:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            if self.writer is threading.current_thread():
+                self.write_depth -= 1
+                return
+
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.write_depth += 1
+                return
+
+            self.writers_waiting += 1
+            while self.writer != None or self.readers > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if self.write_depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    def is_writing(self):
+        """Checks whether the calling thread holds the lock for writing."""
+        return self.writer is threading.current_thread()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class HashIndex:
+    """Secondary index mapping the text form of a field value (as it would
+    appear in a URL) to the logical keys of the entries holding it. Serves
+    equality filters.
+    """
+
+    def __init__(self):
+        self.keys = {}
+
+    @staticmethod
+    def text(value):
+        return value if isinstance(value, basestring) else json.dumps(value)
+
+    def add(self, value, key):
+        self.keys.setdefault(HashIndex.text(value), set()).add(key)
+
+    def build(self, pairs):
+        """Adds a list of (value, key) pairs to the index at once"""
+        for value, key in pairs:
+            self.add(value, key)
+
+    def remove(self, value, key):
+        text = HashIndex.text(value)
+        keys = self.keys.get(text)
+        if keys == None:
+            return
+
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.keys[text]
+
+    def equal(self, text):
+        return set(self.keys.get(text, ()))
+
+    def lookup(self, op, operand):
+        """Returns the keys matching a filter operation; None if the index 
+        cannot serve the operation.
+        """
+
+        if op == 'eq':
+            return self.equal(operand)
+        if op == 'in':
+            return set().union(*[self.equal(text) for text in operand])
+        return None
+
+class SortedIndex:
+    """Secondary index keeping (field value, logical key) pairs in sorted
+    order. Serves equality filters as well as range queries.
+    """
+
+    def __init__(self):
+        self.pairs = []
+
+    def add(self, value, key):
+        bisect.insort(self.pairs, (value, key))
+
+    def build(self, pairs):
+        """Adds a list of (value, key) pairs to the index at once, sorting 
+        them in one pass rather than inserting them one by one.
+        """
+        pairs.extend(self.pairs)
+        pairs.sort()
+        self.pairs = pairs
+
+    def remove(self, value, key):
+        i = bisect.bisect_left(self.pairs, (value, key))
+        if i < len(self.pairs) and self.pairs[i] == (value, key):
+            del self.pairs[i]
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        """Returns the keys of the entries whose value lies between low and 
+        high. A bound of None leaves that side of the range open.
+        """
+
+        start = 0 if low == None else bisect.bisect_left(self.pairs, (low,))
+
+        keys = set()
+        for value, key in itertools.islice(self.pairs, start, None):
+            if not include_low and value == low:
+                continue
+            if high != None and (value > high or 
+                                 (value == high and not include_high)):
+                break
+            keys.add(key)
+
+        return keys
+
+    def equal(self, text):
+        # Values from the URL are text; also look up their JSON reading so 
+        # that '30' finds both '30' and 30
+        keys = self.range(text, text)
+        value = DataHelper.parse_value(text)
+        if value != text and value != None:
+            keys |= self.range(value, value)
+        return keys
+
+    def lookup(self, op, operand):
+        if op == 'eq':
+            return self.equal(operand)
+        if op == 'in':
+            return set().union(*[self.equal(text) for text in operand])
+        if op == 'gt':
+            return self.range(low=operand, include_low=False)
+        if op == 'gte':
+            return self.range(low=operand)
+        if op == 'lt':
+            return self.range(high=operand, include_high=False)
+        if op == 'lte':
+            return self.range(high=operand)
+        if op == 'between':
+            return self.range(operand[0], operand[1])
+        return None
+
+class LazyEntries:
+    """Dictionary-like collection backed by a memory-mapped 'jsonl' data file.
+
+    Opening the file only scans it for line offsets; an entry is decoded the
+    first time it is accessed and kept in a cache that evict() empties. New
+    and modified entries are held in memory until the next snapshot writes 
+    them to a new data file, which is then mapped in place of the old one.
+
+    Each line of the data file has the form:
+
+        <JSON key> TAB <JSON __id__> TAB <JSON entry> NEWLINE
+    """
+
+    def __init__(self, path):
+        """Maps the specified data file, creating it if it does not exist.
+
+        Args:
+            path: data file path
+
+        Returns:
+            None
+        """
+
+        self.path = path
+        self.offsets = {}       # key -> (line start, entry start, line end)
+        self.cache = {}         # key -> decoded entry, same as on file
+        self.changed = {}       # key -> entry not yet written to the file
+        self.ids = {}           # key -> __id__, only until the ID index is built
+        self.mm = None
+        self.last_access = time.time()
+
+        if not os.path.isfile(path):
+            basedir = os.path.dirname(path)
+            if len(basedir) > 0 and not os.path.exists(basedir):
+                os.makedirs(basedir)
+            open(path, 'a').close()
+
+        self.mm = LazyEntries.map_file(path)
+        self.scan()
+
+    @staticmethod
+    def map_file(path):
+        with open(path, 'rb') as data_file:
+            if os.fstat(data_file.fileno()).st_size == 0:
+                return None                     # empty files can't be mapped
+            return mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def scan(self):
+        """Builds the offset index from the mapped file without decoding any
+        entry. Incomplete lines are skipped.
+        """
+
+        mm = self.mm
+        size = 0 if mm == None else len(mm)
+        pos = 0
+        while pos < size:
+            end = mm.find('\n', pos)
+            if end < 0:
+                break                           # torn write at the tail
+
+            tab1 = mm.find('\t', pos, end)
+            tab2 = -1 if tab1 < 0 else mm.find('\t', tab1 + 1, end)
+            if tab2 > 0:
+                key = json.loads(mm[pos:tab1])
+                self.offsets[key] = (pos, tab2 + 1, end)
+                self.ids[key] = json.loads(mm[tab1 + 1:tab2])
+            pos = end + 1
+
+    def take_internal_ids(self):
+        """Returns (key, __id__) pairs of all entries and releases the IDs 
+        collected while scanning.
+        """
+
+        pairs = [(k, i) for k, i in self.ids.iteritems() if k in self.offsets]
+        pairs += [(k, e.get('__id__')) for k, e in self.changed.iteritems()]
+        self.ids = {}
+        return pairs
+
+    def __getitem__(self, key):
+        self.last_access = time.time()
+
+        entry = self.changed.get(key)
+        if entry != None:
+            return entry
+
+        entry = self.cache.get(key)
+        if entry != None:
+            return entry
+
+        start, entry_start, end = self.offsets[key]
+        entry = DataHelper.codec.loads(self.mm[entry_start:end])
+        self.cache[key] = entry
+        return entry
+
+    def __setitem__(self, key, entry):
+        self.offsets.pop(key, None)
+        self.cache.pop(key, None)
+        self.changed[key] = entry
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.offsets.pop(key, None)
+        self.cache.pop(key, None)
+        self.changed.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.changed or key in self.offsets
+
+    def __len__(self):
+        return len(self.changed) + len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if len(default) > 0:
+                return default[0]
+            raise KeyError(key)
+
+        entry = self[key]
+        del self[key]
+        return entry
+
+    def keys(self):
+        return self.offsets.keys() + self.changed.keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def evict(self):
+        """Drops all decoded entries that can be read back from the file."""
+        self.cache = {}
+
+    def freeze(self):
+        """Captures the state to be written by the next snapshot. The caller
+        must hold the write lock of the collection.
+
+        Returns:
+            opaque state for write_snapshot and adopt
+        """
+
+        return (dict(self.offsets), dict(self.changed), self.mm)
+
+    @staticmethod
+    def encode_line(key, entry):
+        text = DataHelper.codec.dumps(entry)
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        prefix = json.dumps(key) + '\t' + json.dumps(entry.get('__id__')) + '\t'
+        return prefix, text
+
+    def write_snapshot(self, frozen, path, fsync):
+        """Writes a frozen state to a new data file, copying unchanged lines
+        from the mapped file as they are. Does not need the collection lock.
+
+        Args:
+            frozen: state returned by freeze
+            path: data file path
+            fsync: if True, flush the new file to disk before returning
+
+        Returns:
+            offsets of the entries in the new file; None on failure
+        """
+
+        offsets, changed, mm = frozen
+        new_offsets = {}
+
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as data_file:
+                pos = 0
+                for key, (start, entry_start, end) in offsets.iteritems():
+                    data_file.write(mm[start:end + 1])
+                    new_offsets[key] = (pos, pos + entry_start - start, 
+                                        pos + end - start)
+                    pos += end + 1 - start
+
+                for key, entry in changed.iteritems():
+                    prefix, text = LazyEntries.encode_line(key, entry)
+                    data_file.write(prefix + text + '\n')
+                    new_offsets[key] = (pos, pos + len(prefix), 
+                                        pos + len(prefix) + len(text))
+                    pos += len(prefix) + len(text) + 1
+
+                if fsync:
+                    data_file.flush()
+                    os.fsync(data_file.fileno())
+        except (ValueError, TypeError, OverflowError, IOError, OSError):
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        try:
+            if os.name == 'nt' and os.path.isfile(path):
+                os.remove(path)                 # rename won't replace on Windows
+            os.rename(tmp_path, path)
+        except OSError:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        if fsync:
+            DataHelper.fsync_dir(os.path.dirname(path))
+
+        return new_offsets
+
+    def adopt(self, frozen, new_offsets):
+        """Switches to the data file written by write_snapshot. Entries that
+        changed after the state was frozen stay in memory. The caller must 
+        hold the write lock of the collection.
+
+        Args:
+            frozen: state passed to write_snapshot
+            new_offsets: offsets returned by write_snapshot
+
+        Returns:
+            None
+        """
+
+        offsets, changed, mm = frozen
+        self.mm = LazyEntries.map_file(self.path)
+
+        for key, location in new_offsets.iteritems():
+            if key in self.offsets:
+                self.offsets[key] = location    # unchanged since frozen
+            elif key in changed and self.changed.get(key) is changed[key]:
+                self.cache[key] = self.changed.pop(key)
+                self.offsets[key] = location
+
+class StorageBackend:
+    """Storage shared by every process serving a collection. Collections 
+    configured with a backend keep their entries in memory as usual, but
+    every write is committed to the backend and every process applies the
+    changes committed by the others before serving a request, so several 
+    worker processes (e.g. under gunicorn) see the same data.
+
+    Changes are numbered by a sequence that increases across all the 
+    collections of a backend; the sequence number of a collection's latest
+    change serves as its version, so ETags agree across processes.
+    """
+
+    generation = None                   # ETag prefix shared by all processes
+
+    def load(self, config):
+        """Returns a tuple of (entries, stamps, sequence number, modification
+        time) for the specified collection, importing its data file on first
+        use. Stamps map the key of each entry to the (sequence number, 
+        modification time) of its latest change.
+        """
+        raise NotImplementedError
+
+    def version(self, collection):
+        """Returns the sequence number of the latest change to a collection"""
+        raise NotImplementedError
+
+    def changes(self, collection, since):
+        """Returns the list of (sequence number, key, entry, modification 
+        time) changes to a collection after the sequence number since, with
+        an entry of None for deletions; None if they are no longer kept.
+        """
+        raise NotImplementedError
+
+    def begin(self, write=True):
+        """Starts a transaction; a write transaction waits for writers in 
+        other processes. Transactions of a thread may nest; only the 
+        outermost one commits.
+        """
+        raise NotImplementedError
+
+    def write(self, collection, operations):
+        """Stores a list of (op, key, entry) operations within the current 
+        transaction; returns a (sequence number, time) tuple per operation.
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+class SqliteBackend(StorageBackend):
+    """Storage backend kept in an SQLite database in WAL mode, which lets
+    readers in any process proceed while a single process writes.
+
+    Sample usage:
+        <code>
+        backend = SqliteBackend('data/store.db')
+        configs.append(CollectionConfig('temperature', 'id', 'data_heat.json',
+                                        backend=backend))
+        </code>
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS entries (collection TEXT, key TEXT, '
+            'body TEXT, seq INTEGER, modified REAL, '
+            'PRIMARY KEY (collection, key))',
+        'CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY '
+            'AUTOINCREMENT, collection TEXT, key TEXT, body TEXT, modified REAL)',
+        'CREATE INDEX IF NOT EXISTS changes_collection '
+            'ON changes (collection, seq)',
+        'CREATE TABLE IF NOT EXISTS versions (collection TEXT PRIMARY KEY, '
+            'seq INTEGER, modified REAL)',
+        'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    def __init__(self, path, timeout=30.0, keep_changes=10000, 
+                 fsync='on-snapshot'):
+        """Opens (creating if needed) an SQLite database as a backend.
+
+        Args:
+            path: database file path
+            timeout: seconds to wait for writers in other processes
+            keep_changes: number of recent changes kept for other processes
+                to catch up with; a process further behind reloads the 
+                collection
+            fsync: durability policy; 'always' syncs every commit, 'never'
+                leaves flushing to the OS, and 'on-snapshot' syncs at WAL
+                checkpoints, which survives process crashes but not power loss
+
+        Returns:
+            None
+        """
+
+        if sqlite3 == None:
+            raise ValueError('SqliteBackend requires the sqlite3 module')
+        if fsync not in ('never', 'on-snapshot', 'always'):
+            raise ValueError('unknown fsync policy: %s' % fsync)
+
+        basedir = os.path.dirname(path)
+        if len(basedir) > 0 and not os.path.exists(basedir):
+            os.makedirs(basedir)
+
+        self.path = path
+        self.timeout = timeout
+        self.keep_changes = keep_changes
+        self.synchronous = {'never': 'OFF', 'on-snapshot': 'NORMAL', 
+                            'always': 'FULL'}[fsync]
+        self.local = threading.local()
+
+        self.begin()
+        try:
+            conn = self.connection()
+            for statement in SqliteBackend.SCHEMA:
+                conn.execute(statement)
+            conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', 
+                         ('generation', uuid.uuid4().hex[:8]))
+            conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', 
+                         ('pruned', '0'))
+            self.generation = conn.execute(
+                "SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def connection(self):
+        """Returns the connection of the calling thread, opening a new one in
+        a process forked after the previous one was opened.
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn == None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, 
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=%s' % self.synchronous)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.depth = 0
+            self.local.active = False
+        return conn
+
+    @staticmethod
+    def encode(entry):
+        text = DataHelper.codec.dumps(entry)
+        return text.decode('utf-8') if isinstance(text, str) else text
+
+    def load(self, config):
+        conn = self.connection()
+        row = conn.execute('SELECT seq, modified FROM versions '
+                           'WHERE collection = ?', (config.name,)).fetchone()
+        if row == None:
+            self.begin()
+            try:
+                self.import_data(config)
+            except:
+                self.rollback()
+                raise
+            self.commit()
+
+        self.begin(False)               # reads entries and version together
+        try:
+            seq, modified = conn.execute('SELECT seq, modified FROM versions '
+                'WHERE collection = ?', (config.name,)).fetchone()
+            entries = {}
+            stamps = {}
+            for key, body, entry_seq, entry_modified in conn.execute(
+                    'SELECT key, body, seq, modified FROM entries '
+                    'WHERE collection = ?', (config.name,)):
+                key = json.loads(key)
+                entries[key] = DataHelper.codec.loads(body)
+                stamps[key] = (entry_seq, entry_modified)
+        finally:
+            self.commit()
+
+        return entries, stamps, seq, modified
+
+    def import_data(self, config):
+        """Copies the data file of a collection into the database, unless 
+        another process already did. Must run within a transaction.
+        """
+
+        conn = self.connection()
+        if conn.execute('SELECT 1 FROM versions WHERE collection = ?', 
+                        (config.name,)).fetchone() != None:
+            return
+
+        now = time.time()
+        if os.path.isfile(config.data_file):
+            entries = DataHelper.load_data(config.data_file, None, 
+                                           config.storage_format)
+            conn.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0, ?)',
+                ((config.name, json.dumps(key), SqliteBackend.encode(entry), 
+                  now) for key, entry in entries.iteritems()))
+
+        conn.execute('INSERT INTO versions VALUES (?, 0, ?)', 
+                     (config.name, now))
+
+    def version(self, collection):
+        row = self.connection().execute('SELECT seq FROM versions '
+            'WHERE collection = ?', (collection,)).fetchone()
+        return None if row == None else row[0]
+
+    def changes(self, collection, since):
+        conn = self.connection()
+        self.begin(False)
+        try:
+            pruned = int(conn.execute(
+                "SELECT value FROM meta WHERE name = 'pruned'").fetchone()[0])
+            if since < pruned:
+                return None
+
+            return [(seq, json.loads(key), 
+                     None if body == None else DataHelper.codec.loads(body), 
+                     modified)
+                    for seq, key, body, modified in conn.execute(
+                        'SELECT seq, key, body, modified FROM changes '
+                        'WHERE collection = ? AND seq > ? ORDER BY seq', 
+                        (collection, since))]
+        finally:
+            self.commit()
+
+    def begin(self, write=True):
+        conn = self.connection()
+        if self.local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            self.local.active = True
+        self.local.depth += 1
+
+    def write(self, collection, operations):
+        conn = self.connection()
+        now = time.time()
+        results = []
+        for op, key, entry in operations:
+            key_text = json.dumps(key)
+            body = None if op == 'del' else SqliteBackend.encode(entry)
+            seq = conn.execute('INSERT INTO changes (collection, key, body, '
+                'modified) VALUES (?, ?, ?, ?)', 
+                (collection, key_text, body, now)).lastrowid
+
+            if body == None:
+                conn.execute('DELETE FROM entries WHERE collection = ? '
+                             'AND key = ?', (collection, key_text))
+            else:
+                conn.execute('INSERT OR REPLACE INTO entries '
+                             'VALUES (?, ?, ?, ?, ?)', 
+                             (collection, key_text, body, seq, now))
+            results.append((seq, now))
+
+        if len(results) > 0:
+            conn.execute('UPDATE versions SET seq = ?, modified = ? '
+                         'WHERE collection = ?', (seq, now, collection))
+            if seq % 1000 < len(results):  # every thousand or so changes
+                self.prune(seq - self.keep_changes)
+
+        return results
+
+    def prune(self, upto):
+        if upto <= 0:
+            return
+
+        conn = self.connection()
+        conn.execute('DELETE FROM changes WHERE seq <= ?', (upto,))
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'pruned'", 
+                     (str(upto),))
+
+    def commit(self):
+        conn = self.connection()
+        self.local.depth = max(self.local.depth - 1, 0)
+        if self.local.depth == 0 and self.local.active:
+            conn.execute('COMMIT')
+            self.local.active = False
+
+    def rollback(self):
+        conn = self.connection()
+        self.local.depth = max(self.local.depth - 1, 0)
+        if self.local.active:
+            self.local.active = False       # rolls back enclosing levels too
+            conn.execute('ROLLBACK')
+
+class LazyManager:
+    """Serves as the manager or engine of this REST API service 
+
+    Sample usage:
+        <code>    
+        from flask import Flask, Response, request, send_from_directory
+        import json, pprint
+        import uuid
+
+        from rest_api_helper import LazyManager, CollectionConfig, DataHelper
+
+        # Initialize the simplified no-SQL/flat-file data storage
+        configs = []
+        configs.append(CollectionConfig('temperature', 'id', 'data_heat.json'))
+
+        manager = LazyManager()
+        manager.init(configs)
+
+        app = Flask(__name__, static_url_path='/static')
+
+
+        @app.route("/api/<collection>", defaults={'entry_id': None}, methods=['POST', 'GET', 'PUT'])
+        @app.route("/api/<collection>/<entry_id>", methods=['PUT', 'GET', 'DELETE'])
+        @app.route("/api/<collection>", defaults={'entry_id': None}, methods=['POST', 'PUT'])
+        @app.route("/api/<collection>/<entry_id>", methods=['PUT'])
+        def handle_api(collection, entry_id):
+            global manager
+            resp = manager.process_request(request, collection, entry_id)
+            return resp
+
+        # @app.route('/')
+        # @app.route('/<path:path>')
+        # def handle_index(path='index.html'):
+        #     print 'path: [', path, ']'
+        #     return send_from_directory('static', path)
+
+        if __name__ == "__main__":
+            try:
+                app.run(host='0.0.0.0', port=8001)
+            finally:
+                manager.handle_shutdown()
+
+        </code>
+    """
+
+    locks = {}
+    records = {}
+    collection_configs = {}
+    id_indexes = {}                     # collection -> {__id__: logical key}
+    journals = {}                       # collection -> open journal per shard
+    journal_counts = {}                 # collection -> records since compaction
+    dirty = {}                          # collection -> unsaved mutations
+    dirty_shards = {}                   # collection -> shards with unsaved changes
+    versions = {}                       # collection -> mutation counter
+    body_cache = {}                     # collection -> (version, JSON body)
+    generation = uuid.uuid4().hex[:8]   # distinguishes ETags across restarts
+    modified = {}                       # collection -> last change time
+    loaded = {}                         # collection -> load time
+    entry_stamps = {}                   # collection -> {__id__: (version, time)}
+    sorted_keys = {}                    # collection -> (version, sorted keys)
+    field_indexes = {}                  # collection -> {field: index}
+    compact_pending = set()             # collections to compact after writing
+    save_locks = {}                     # collection -> lock held while saving
+    snapshots = {}                      # collection -> (version, frozen copy)
+    load_times = {}                     # collection -> seconds spent loading
+    shared_versions = {}                # collection -> backend change applied
+    startup_time = None                 # seconds spent loading all collections
+
+    FILTER_OPS = ('gt', 'gte', 'lt', 'lte', 'between', 'in')
+    BATCH_COLLECTION = '_batch'         # POST /<prefix>/_batch runs a batch
+
+    save_deadline = None                # seconds allowed for the shutdown save
+
+    snapshot_thread = None
+    snapshot_tick = 1.0
+    snapshot_stop = threading.Event()
+    snapshot_wakeup = threading.Event()
+
+    def __init__(self):
+        #self.data = []
+        pass
+    
+    @staticmethod
+    def init(collection_config_list, workers=None):
+        """Initializes the manager with a list of configuration for each 
+        collection that it will manage. Data files of non-lazy collections
+        are decoded concurrently by a pool of loader processes; indexes are
+        then built in this process.
+
+        Args:
+            collection_config_list: list of collection configuration
+            workers: number of loader processes; defaults to the number of
+                CPUs, and a value of 1 loads every collection in-process
+
+        Returns:
+            None
+        """
+
+        started = time.time()
+        loaded = LazyManager.load_collections(
+            [config for config in collection_config_list 
+             if not config.lazy and config.backend == None],
+            workers)
+
+        for config in collection_config_list:
+            LazyManager.collection_configs[config.name] = config
+            LazyManager.locks[config.name] = ReadWriteLock()
+            LazyManager.save_locks[config.name] = threading.Lock()
+            if config.lazy:
+                load_started = time.time()
+                LazyManager.records[config.name] = LazyManager.load_lazy(config)
+                LazyManager.load_times[config.name] = time.time() - load_started
+            elif config.backend != None:
+                load_started = time.time()
+                LazyManager.load_shared(config)
+                LazyManager.load_times[config.name] = time.time() - load_started
+            else:
+                LazyManager.records[config.name], \
+                    LazyManager.load_times[config.name] = loaded[config.name]
+            LazyManager.build_id_index(config.name)
+            LazyManager.build_field_indexes(config.name)
+            if config.backend == None:
+                LazyManager.loaded[config.name] = time.time()
+                LazyManager.modified[config.name] = LazyManager.loaded[config.name]
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('loaded %s: %d entries from %s in %.3fs', 
+                            config.name, len(LazyManager.records[config.name]),
+                            config.data_file, LazyManager.load_times[config.name])
+
+            LazyManager.dirty_shards[config.name] = set()
+            if config.journal_file != None:
+                LazyManager.journals[config.name] = [
+                    open(journal_file, 'a') 
+                    for journal_file in config.journal_files]
+                LazyManager.journal_counts[config.name] = 0
+
+        LazyManager.startup_time = time.time() - started
+        logger.info('loaded %d collections in %.3fs', 
+                    len(collection_config_list), LazyManager.startup_time)
+
+        LazyManager.start_snapshots()
+        atexit.register(LazyManager.handle_shutdown)
+
+    @staticmethod
+    def load_collections(configs, workers=None):
+        """Loads the data files of the specified collections, using a pool of
+        processes when there is more than one file to decode. Falls back to
+        loading in-process if the pool cannot be created. The shards of a
+        sharded collection are loaded separately and then merged.
+
+        Args:
+            configs: list of configuration of non-lazy collections
+            workers: number of loader processes; defaults to the number of
+                CPUs
+
+        Returns:
+            dictionary of collection name to (entries, seconds spent loading)
+        """
+
+        tasks = [(data_file, journal_file, config.storage_format)
+                 for config in configs
+                 for data_file, journal_file in zip(config.data_files, 
+                                                    config.journal_files)]
+
+        if workers == None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        workers = min(workers, len(tasks))
+
+        results = None
+        if workers > 1:
+            try:
+                pool = multiprocessing.Pool(workers)
+            except (OSError, ImportError):
+                pool = None
+
+            if pool != None:
+                try:
+                    results = pool.map(load_collection_data, tasks, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        if results == None:
+            results = [load_collection_data(task) for task in tasks]
+
+        loaded = {}
+        results = iter(results)
+        for config in configs:
+            entries, seconds = next(results)
+            for shard in range(1, config.shards):
+                shard_entries, shard_seconds = next(results)
+                entries.update(shard_entries)
+                seconds += shard_seconds
+            loaded[config.name] = (entries, seconds)
+
+        return loaded
+
+    def get_records(self):
+        return LazyManager.records
+
+    @staticmethod
+    def load_lazy(config):
+        """Maps the data file of a lazy collection and replays its journal.
+
+        Args:
+            config: collection configuration
+
+        Returns:
+            LazyEntries of the collection
+        """
+
+        entries = LazyEntries(config.data_file)
+        if config.journal_file != None:
+            DataHelper.replay_journal(config.journal_file + '.1', entries)
+            DataHelper.replay_journal(config.journal_file, entries)
+
+        return entries
+
+    @staticmethod
+    def load_shared(config):
+        """Loads a collection from its storage backend, replacing any entries
+        already in memory.
+
+        Args:
+            config: collection configuration
+
+        Returns:
+            None
+        """
+
+        entries, stamps, version, modified = config.backend.load(config)
+
+        LazyManager.records[config.name] = entries
+        LazyManager.versions[config.name] = version
+        LazyManager.shared_versions[config.name] = version
+        LazyManager.loaded[config.name] = modified
+        LazyManager.modified[config.name] = modified
+        LazyManager.entry_stamps[config.name] = dict(
+            (entry['__id__'], stamps[key]) 
+            for key, entry in entries.iteritems() if entry.has_key('__id__'))
+
+    @staticmethod
+    def refresh(collection):
+        """Applies the changes other processes made to a collection through 
+        its storage backend. Does nothing for other collections.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            None
+        """
+
+        backend = LazyManager.collection_configs[collection].backend
+        if backend == None or backend.version(collection) == \
+                LazyManager.shared_versions.get(collection):
+            return
+
+        with LazyManager.locks[collection].write():
+            LazyManager.refresh_locked(collection)
+
+    @staticmethod
+    def refresh_locked(collection):
+        config = LazyManager.collection_configs[collection]
+        since = LazyManager.shared_versions.get(collection)
+        if since != None and config.backend.version(collection) == since:
+            return
+
+        changes = None if since == None else \
+            config.backend.changes(collection, since)
+        if changes == None:                     # too far behind; reload
+            LazyManager.load_shared(config)
+            LazyManager.build_id_index(collection)
+            LazyManager.build_field_indexes(collection)
+            LazyManager.body_cache.pop(collection, None)
+            LazyManager.snapshots.pop(collection, None)
+            LazyManager.sorted_keys.pop(collection, None)
+            return
+
+        entries = LazyManager.records[collection]
+        for version, key, entry, modified in changes:
+            old_entry = entries.get(key)
+            LazyManager.update_field_indexes(collection, key, old_entry, entry)
+            if old_entry != None:
+                LazyManager.unindex_entry(collection, old_entry.get('__id__'))
+
+            internal_id = None
+            if entry == None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+                internal_id = entry.get('__id__')
+                LazyManager.index_entry(collection, internal_id, key)
+
+            LazyManager.bump_version(collection, internal_id, version, modified)
+            LazyManager.shared_versions[collection] = version
+
+    @staticmethod
+    def evict(collection):
+        """Drops the decoded entries of a lazy collection, along with cached 
+        snapshots and bodies, keeping only what cannot be read back from its
+        data file.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            True if the collection is lazy; otherwise, false
+        """
+
+        entries = LazyManager.records[collection]
+        if not isinstance(entries, LazyEntries):
+            return False
+
+        with LazyManager.locks[collection].write():
+            entries.evict()
+            LazyManager.snapshots.pop(collection, None)
+            LazyManager.body_cache.pop(collection, None)
+            LazyManager.sorted_keys.pop(collection, None)
+
+        return True
+
+    @staticmethod
+    def build_id_index(collection):
+        """Rebuilds the __id__ to logical key index of the specified collection
+        from its current records.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            None
+        """
+
+        entries = LazyManager.records[collection]
+
+        index = {}
+        if isinstance(entries, LazyEntries):
+            for key, internal_id in entries.take_internal_ids():
+                index[internal_id] = key
+        else:
+            for key, entry in entries.iteritems():
+                if entry.has_key('__id__'):
+                    index[entry['__id__']] = key
+
+        LazyManager.id_indexes[collection] = index
+
+    @staticmethod
+    def build_field_indexes(collection):
+        """Builds the secondary field indexes declared in the configuration of
+        the specified collection from its current records.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            None
+        """
+
+        config = LazyManager.collection_configs[collection]
+        indexes = {}
+        for field, kind in (config.indexes or {}).iteritems():
+            indexes[field] = HashIndex() if kind == 'hash' else SortedIndex()
+
+        LazyManager.field_indexes[collection] = indexes
+        if len(indexes) == 0:
+            return
+
+        pairs = dict((field, []) for field in indexes)
+        for key, entry in LazyManager.records[collection].iteritems():
+            for field in indexes:
+                if entry.has_key(field):
+                    pairs[field].append((entry[field], key))
+
+        for field, index in indexes.iteritems():
+            index.build(pairs[field])
+
+        LazyManager.field_indexes[collection] = indexes
+
+    @staticmethod
+    def update_field_indexes(collection, key, old_entry, new_entry):
+        """Moves an entry within the secondary field indexes of a collection
+        after it was added, replaced or deleted.
+
+        Args:
+            collection: collection name
+            key: logical key of the entry
+            old_entry: entry previously stored under key; None if added
+            new_entry: entry now stored under key; None if deleted
+
+        Returns:
+            None
+        """
+
+        for field, index in LazyManager.field_indexes.get(collection, {}).iteritems():
+            if old_entry != None and old_entry.has_key(field):
+                index.remove(old_entry[field], key)
+            if new_entry != None and new_entry.has_key(field):
+                index.add(new_entry[field], key)
+
+    @staticmethod
+    def index_entry(collection, internal_id, key):
+        LazyManager.id_indexes.setdefault(collection, {})[internal_id] = key
+
+    @staticmethod
+    def unindex_entry(collection, internal_id):
+        LazyManager.id_indexes.get(collection, {}).pop(internal_id, None)
+        LazyManager.entry_stamps.get(collection, {}).pop(internal_id, None)
+
+    @staticmethod
+    def log_operation(collection, op, key, entry=None):
+        """Bumps the version of the specified collection, marks it as dirty and
+        records the mutation in its journal, if it has one. Once the journal
+        grows past compact_every it is compacted, deferred until the end of
+        the enclosing writing() block if there is one.
+
+        Args:
+            collection: collection name
+            op: 'put' or 'del'
+            key: logical key of the affected entry
+            entry: the stored entry for 'put' operations
+
+        Returns:
+            None
+        """
+
+        LazyManager.log_operations(collection, [(op, key, entry)])
+
+    @staticmethod
+    def log_operations(collection, operations, atomic=False):
+        """Logs several mutations of a collection at once, like log_operation,
+        appending them to the journal in a single write.
+
+        Args:
+            collection: collection name
+            operations: list of (op, key, entry) tuples
+            atomic: if True, journal the operations as a single record so that
+                a crash replays either all of them or none
+
+        Returns:
+            None
+        """
+
+        if len(operations) == 0:
+            return
+
+        config = LazyManager.collection_configs[collection]
+        if config.backend != None:
+            LazyManager.write_shared(collection, operations)
+            return
+
+        for op, key, entry in operations:
+            LazyManager.bump_version(collection, 
+                None if entry == None else entry.get('__id__'))
+        LazyManager.mark_dirty(collection, len(operations))
+
+        shards = {}
+        for operation in operations:
+            shard = DataHelper.shard_of(operation[1], config.shards)
+            shards.setdefault(shard, []).append(operation)
+
+        lock = LazyManager.locks[collection]
+        with lock.write():
+            LazyManager.dirty_shards[collection].update(shards)
+            journal_files = LazyManager.journals.get(collection)
+            if journal_files == None:
+                return
+
+            # add_entries rejects atomic batches of sharded collections, as a 
+            # batch spanning shards could only be atomic within each shard
+            for shard, shard_operations in shards.iteritems():
+                DataHelper.append_journal(journal_files[shard], shard_operations,
+                    config.fsync == DataHelper.FSYNC_ALWAYS, atomic)
+            LazyManager.journal_counts[collection] += len(operations)
+            count = LazyManager.journal_counts[collection]
+
+        if count < config.compact_every:
+            return
+
+        if lock.is_writing():
+            LazyManager.compact_pending.add(collection)
+        else:
+            LazyManager.compact(collection)
+
+    @staticmethod
+    def write_shared(collection, operations):
+        """Commits mutations of a collection to its storage backend, stamping
+        the changed entries with the sequence numbers of the changes.
+
+        Args:
+            collection: collection name
+            operations: list of (op, key, entry) tuples
+
+        Returns:
+            None
+        """
+
+        backend = LazyManager.collection_configs[collection].backend
+        with LazyManager.locks[collection].write():
+            backend.begin()
+            try:
+                stamps = backend.write(collection, operations)
+            except:
+                backend.rollback()
+                raise
+            backend.commit()
+
+            for (op, key, entry), (version, now) in zip(operations, stamps):
+                LazyManager.bump_version(collection, 
+                    None if entry == None else entry.get('__id__'), version, now)
+                LazyManager.shared_versions[collection] = version
+
+    @staticmethod
+    @contextlib.contextmanager
+    def writing(collection):
+        """Context manager holding the write lock of a collection. Compaction
+        that came due inside the block runs once the lock is released, so that
+        writers are not held up by the snapshot.
+
+        For a collection with a storage backend, the block also runs within a
+        backend transaction, after catching up with changes made by other 
+        processes. If the block fails, the collection is reloaded before it 
+        is next used.
+
+        Args:
+            collection: collection name
+        """
+
+        lock = LazyManager.locks[collection]
+        backend = LazyManager.collection_configs[collection].backend
+        if backend == None or lock.is_writing():
+            with lock.write():
+                yield
+        else:
+            with lock.write():
+                backend.begin()
+                try:
+                    LazyManager.refresh_locked(collection)
+                    yield
+                    backend.commit()
+                except:
+                    backend.rollback()
+                    LazyManager.shared_versions[collection] = None
+                    raise
+
+        if not lock.is_writing() and collection in LazyManager.compact_pending:
+            LazyManager.compact_pending.discard(collection)
+            LazyManager.compact(collection)
+
+    @staticmethod
+    def reading(collection):
+        """Context manager holding the read lock of a collection."""
+        return LazyManager.locks[collection].read()
+
+    @staticmethod
+    def compact(collection):
+        """Writes a snapshot of the specified collection to its data file and
+        starts a new, empty journal. Snapshots of the same collection are 
+        never written concurrently. Of a sharded collection, only the shards
+        changed since their last snapshot are written, concurrently.
+
+        The journal is first rotated aside so that writes made while the 
+        snapshot is being written land in a fresh journal; the rotated journal
+        is only removed once the snapshot is safely on disk.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            True on success; otherwise, false
+        """
+
+        if LazyManager.collection_configs[collection].backend != None:
+            return True                         # every write is already stored
+
+        with LazyManager.save_locks[collection]:
+            return LazyManager.compact_locked(collection)
+
+    @staticmethod
+    def compact_locked(collection):
+        config = LazyManager.collection_configs[collection]
+        entries = LazyManager.records[collection]
+        lazy = isinstance(entries, LazyEntries)
+        rotated = {}
+        started = time.time()
+
+        with LazyManager.locks[collection].write():
+            dirty = LazyManager.dirty.get(collection, 0)
+            LazyManager.dirty[collection] = 0
+            if config.shards == 1:
+                shards = [0]
+            else:
+                shards = sorted(LazyManager.dirty_shards[collection])
+            LazyManager.dirty_shards[collection] = set()
+
+        # Any failure from here on leaves the collection dirty, its rotated
+        # journals in place, and is reported rather than raised
+        try:
+            with LazyManager.locks[collection].write():
+                if lazy:
+                    data = entries.freeze()
+                else:
+                    data = LazyManager.get_snapshot(collection)[1]
+
+                if config.journal_file != None:
+                    for shard in shards:
+                        rotated[shard] = LazyManager.rotate_journal(collection, 
+                                                                    shard)
+                    LazyManager.journal_counts[collection] = 0
+
+            fsync = config.fsync != DataHelper.FSYNC_NEVER
+            if lazy:
+                new_offsets = entries.write_snapshot(data, config.data_file, 
+                                                     fsync)
+                if new_offsets == None:
+                    failed = [0]
+                else:
+                    failed = []
+                    with LazyManager.locks[collection].write():
+                        entries.adopt(data, new_offsets)
+            else:
+                failed = LazyManager.save_shards(collection, data, shards, fsync)
+
+            for shard in shards:
+                if shard not in failed and \
+                        os.path.isfile(rotated.get(shard, '')):
+                    os.remove(rotated[shard])
+        except Exception:
+            logger.exception('failed to save %s', collection)
+            failed = shards
+
+        if len(failed) > 0:
+            logger.error('failed to save %s to %s', collection, 
+                ', '.join(config.data_files[shard] for shard in failed))
+            with LazyManager.locks[collection].write():
+                LazyManager.dirty_shards[collection].update(failed)
+            LazyManager.mark_dirty(collection, max(dirty, 1))
+            return False
+
+        logger.info('saved %s: %d entries to %s in %.3fs', collection, 
+                    len(entries), 
+                    ', '.join(config.data_files[shard] for shard in shards), 
+                    time.time() - started)
+        return True
+
+    @staticmethod
+    def rotate_journal(collection, shard):
+        """Moves the journal of a collection shard aside and starts a new, 
+        empty one. The caller must hold the write lock of the collection.
+
+        Args:
+            collection: collection name
+            shard: shard number; 0 for unsharded collections
+
+        Returns:
+            path of the rotated journal
+        """
+
+        config = LazyManager.collection_configs[collection]
+        path = config.journal_files[shard]
+        journal_files = LazyManager.journals.setdefault(collection, 
+                                                        [None] * config.shards)
+        if journal_files[shard] != None:
+            journal_files[shard].close()
+
+        rotated = path + '.1'
+        try:
+            if not os.path.isfile(path):
+                pass
+            elif os.path.isfile(rotated):
+                # Left over from an earlier failed snapshot; keep its records
+                # ahead of the current ones
+                with open(rotated, 'a') as rotated_file:
+                    with open(path, 'r') as journal_file:
+                        shutil.copyfileobj(journal_file, rotated_file)
+                os.remove(path)
+            else:
+                os.rename(path, rotated)
+        finally:
+            # Keep journaling even if the journal could not be moved aside
+            journal_files[shard] = open(path, 'a')
+
+        return rotated
+
+    @staticmethod
+    def save_shards(collection, data, shards, fsync):
+        """Writes the specified shards of a collection snapshot to their data
+        files, concurrently when there are several.
+
+        Args:
+            collection: collection name
+            data: snapshot of the collection entries
+            shards: shard numbers to write; [0] for unsharded collections
+            fsync: if True, flush each data file to disk
+
+        Returns:
+            list of the shards that failed to save
+        """
+
+        config = LazyManager.collection_configs[collection]
+        if config.shards == 1:
+            parts = {0: data}
+        else:
+            parts = dict((shard, {}) for shard in shards)
+            for key, entry in data.iteritems():
+                part = parts.get(DataHelper.shard_of(key, config.shards))
+                if part != None:
+                    part[key] = entry
+
+        results = {}
+
+        def save_shard(shard):
+            try:
+                results[shard] = DataHelper.save_data(config.data_files[shard],
+                    parts[shard], fsync, config.storage_format)
+            except Exception:
+                logger.exception('failed to save %s', config.data_files[shard])
+
+        threads = [threading.Thread(target=save_shard, args=(shard,))
+                   for shard in shards[1:]]
+        for thread in threads:
+            thread.start()
+        if len(shards) > 0:
+            save_shard(shards[0])
+        for thread in threads:
+            thread.join()
+
+        return [shard for shard in shards if not results.get(shard, False)]
+
+    @staticmethod
+    def bump_version(collection, internal_id=None, version=None, now=None):
+        """Records a change to the specified collection, invalidating its 
+        cached body. The changed entry, if given, is stamped with the new
+        collection version and modification time.
+
+        Args:
+            collection: collection name
+            internal_id: internal ID (__id__) of the changed entry, if any
+            version: new collection version; defaults to the next one
+            now: modification time; defaults to the current time
+
+        Returns:
+            None
+        """
+
+        if version == None:
+            version = LazyManager.versions.get(collection, 0) + 1
+        if now == None:
+            now = time.time()
+
+        LazyManager.versions[collection] = version
+        LazyManager.modified[collection] = now
+        LazyManager.body_cache.pop(collection, None)
+        LazyManager.snapshots.pop(collection, None)
+
+        if internal_id != None:
+            stamps = LazyManager.entry_stamps.setdefault(collection, {})
+            stamps[internal_id] = (version, now)
+
+    @staticmethod
+    def get_validators(collection, entry_id=None):
+        """Returns the ETag and the last modification time of the specified 
+        collection, or of one of its entries.
+
+        Args:
+            collection: collection name
+            entry_id: internal ID (__id__) of the entry, if any
+
+        Returns:
+            tuple of unquoted ETag and modification timestamp; None if the
+            entry is not found
+        """
+
+        if entry_id == None or len(entry_id) == 0:
+            version = LazyManager.versions.get(collection, 0)
+            modified = LazyManager.modified[collection]
+        else:
+            with LazyManager.reading(collection):
+                if LazyManager.find_key(collection, entry_id) == None:
+                    return None
+
+                version, modified = LazyManager.entry_stamps.get(
+                    collection, {}).get(entry_id, 
+                        (0, LazyManager.loaded[collection]))
+
+        backend = LazyManager.collection_configs[collection].backend
+        generation = LazyManager.generation if backend == None \
+            else backend.generation
+        return '%s-%d' % (generation, version), modified
+
+    @staticmethod
+    def is_not_modified(request, etag, modified):
+        """Checks the conditional headers of a request against the current 
+        validators of the requested resource.
+        """
+
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+
+        since = request.if_modified_since
+        if since != None:
+            return int(modified) <= calendar.timegm(since.utctimetuple())
+
+        return False
+
+    @staticmethod
+    def get_serialized(collection):
+        """Returns the JSON body of the whole collection, reusing the cached
+        body if the collection has not changed since it was serialized.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            JSON body of the collection
+        """
+
+        cached = LazyManager.body_cache.get(collection)
+        if cached != None and \
+                cached[0] == LazyManager.versions.get(collection, 0):
+            return cached[1]
+
+        # Serialize a point-in-time snapshot without holding the lock; writes
+        # made meanwhile bump the version, so the body is cached under the
+        # version it actually represents
+        version, snapshot = LazyManager.get_snapshot(collection)
+        body = DataHelper.codec.dumps(snapshot)
+
+        LazyManager.body_cache[collection] = (version, body)
+        return body
+
+    @staticmethod
+    def get_snapshot(collection):
+        """Returns an immutable point-in-time view of a collection. The view is
+        a shallow copy taken under the read lock and shared by all readers 
+        until the collection changes; it stays valid while writers proceed
+        because stored entries are never modified in place, only replaced.
+
+        Args:
+            collection: collection name
+
+        Returns:
+            tuple of collection version and dictionary of entries, which must 
+            not be modified
+        """
+
+        cached = LazyManager.snapshots.get(collection)
+        if cached != None and \
+                cached[0] == LazyManager.versions.get(collection, 0):
+            return cached
+
+        with LazyManager.reading(collection):
+            version = LazyManager.versions.get(collection, 0)
+            snapshot = (version, dict(LazyManager.records[collection]))
+
+        LazyManager.snapshots[collection] = snapshot
+        return snapshot
+
+    @staticmethod
+    def mark_dirty(collection, count=1):
+        count = LazyManager.dirty.get(collection, 0) + count
+        LazyManager.dirty[collection] = count
+
+        config = LazyManager.collection_configs[collection]
+        if config.snapshot_max_dirty != None and \
+                count >= config.snapshot_max_dirty:
+            LazyManager.snapshot_wakeup.set()
+
+    @staticmethod
+    def run_snapshots():
+        """Body of the background snapshot thread. Periodically writes every
+        collection that has unsaved changes and whose snapshot interval has 
+        elapsed or whose dirty counter has reached snapshot_max_dirty, and
+        evicts lazy collections that have not been accessed for evict_after.
+
+        Returns:
+            None
+        """
+
+        last_saved = {}
+        while not LazyManager.snapshot_stop.is_set():
+            LazyManager.snapshot_wakeup.wait(LazyManager.snapshot_tick)
+            LazyManager.snapshot_wakeup.clear()
+
+            now = time.time()
+            for name, config in LazyManager.collection_configs.items():
+                if LazyManager.snapshot_stop.is_set():
+                    break
+
+                try:
+                    LazyManager.run_snapshot(name, config, now, last_saved)
+                except Exception:               # keep the thread alive
+                    logger.exception('snapshot of %s failed', name)
+
+    @staticmethod
+    def run_snapshot(name, config, now, last_saved):
+        if config.evict_after != None:
+            LazyManager.evict_if_idle(name, now)
+
+        dirty = LazyManager.dirty.get(name, 0)
+        if dirty == 0:
+            return
+
+        due = config.snapshot_interval != None and \
+            now - last_saved.get(name, 0) >= config.snapshot_interval
+        full = config.snapshot_max_dirty != None and \
+            dirty >= config.snapshot_max_dirty
+
+        if due or full:
+            LazyManager.compact(name)
+            last_saved[name] = now
+
+    @staticmethod
+    def evict_if_idle(collection, now):
+        config = LazyManager.collection_configs[collection]
+        entries = LazyManager.records[collection]
+        if not isinstance(entries, LazyEntries) or \
+                now - entries.last_access < config.evict_after:
+            return
+
+        if len(entries.cache) == 0 and len(entries.changed) == 0:
+            return                              # already cold
+
+        if LazyManager.dirty.get(collection, 0) > 0:
+            LazyManager.compact(collection)     # frees the changed entries
+        LazyManager.evict(collection)
+
+    @staticmethod
+    def start_snapshots():
+        """Starts the background snapshot thread if any collection is 
+        configured with a snapshot interval, a dirty-operation limit or an
+        eviction delay.
+
+        Returns:
+            None
+        """
+
+        intervals = [c.snapshot_interval 
+            for c in LazyManager.collection_configs.itervalues()
+            if c.snapshot_interval != None]
+        limits = [c.snapshot_max_dirty
+            for c in LazyManager.collection_configs.itervalues()
+            if c.snapshot_max_dirty != None]
+        intervals += [c.evict_after
+            for c in LazyManager.collection_configs.itervalues()
+            if c.evict_after != None]
+
+        if len(intervals) == 0 and len(limits) == 0:
+            return
+
+        if LazyManager.snapshot_thread != None and \
+                LazyManager.snapshot_thread.is_alive():
+            return
+
+        LazyManager.snapshot_tick = min(intervals) if len(intervals) > 0 else 1.0
+        LazyManager.snapshot_stop.clear()
+        thread = threading.Thread(target=LazyManager.run_snapshots,
+                                  name='rest-api-snapshot')
+        thread.daemon = True
+        thread.start()
+        LazyManager.snapshot_thread = thread
+
+    @staticmethod
+    def stop_snapshots(timeout=None):
+        """Stops the background snapshot thread, waiting for a snapshot in 
+        progress to finish.
+
+        Args:
+            timeout: optional number of seconds to wait for the thread
+
+        Returns:
+            None
+        """
 
-            open(path, 'a').close()             # Create the file
+        thread = LazyManager.snapshot_thread
+        if thread == None:
+            return
 
-        with open(path, 'w') as data_file:
-            try:
-                entries = json.dump(data, data_file)
-            except ValueError:
-                return False
+        LazyManager.snapshot_stop.set()
+        LazyManager.snapshot_wakeup.set()
+        thread.join(timeout)
+        LazyManager.snapshot_thread = None
 
-        return True
+    @staticmethod
+    def find_key(collection, entry_id):
+        """Finds the logical key (value of the id_field) of the entry having the
+        specified internal ID.
 
-class LazyManager:
-    """Serves as the manager or engine of this REST API service 
+        Args:
+            collection: collection name
+            entry_id: internal ID (__id__) of the entry
 
-    Sample usage:
-        <code>    
-        from flask import Flask, Response, request, send_from_directory
-        import json, pprint
-        import uuid
+        Returns:
+            logical key of the entry; None if not found
+        """
 
-        from rest_api_helper import LazyManager, CollectionConfig, DataHelper
+        key = LazyManager.id_indexes.get(collection, {}).get(entry_id)
+        if key == None:
+            return None
 
-        # Initialize the simplified no-SQL/flat-file data storage
-        configs = []
-        configs.append(CollectionConfig('temperature', 'id', 'data_heat.json'))
+        entry = LazyManager.records[collection].get(key)
+        if entry == None or entry.get('__id__') != entry_id:
+            return None                         # stale index entry
 
-        manager = LazyManager()
-        manager.init(configs)
+        return key
 
-        app = Flask(__name__, static_url_path='/static')
+    @staticmethod
+    def wants_stream(request, collection):
+        """Checks whether a full-collection read should be streamed, either
+        because the collection is configured to stream or because the client
+        asked for it with the stream query parameter.
+        """
 
+        value = request.args.get('stream')
+        if value != None:
+            return value.lower() not in ('0', 'false', 'no')
 
-        @app.route("/api/<collection>", defaults={'entry_id': None}, methods=['POST', 'GET', 'PUT'])
-        @app.route("/api/<collection>/<entry_id>", methods=['PUT', 'GET', 'DELETE'])
-        @app.route("/api/<collection>", defaults={'entry_id': None}, methods=['POST', 'PUT'])
-        @app.route("/api/<collection>/<entry_id>", methods=['PUT'])
-        def handle_api(collection, entry_id):
-            global manager
-            resp = manager.process_request(request, collection, entry_id)
-            return resp
+        return LazyManager.collection_configs[collection].stream
 
-        # @app.route('/')
-        # @app.route('/<path:path>')
-        # def handle_index(path='index.html'):
-        #     print 'path: [', path, ']'
-        #     return send_from_directory('static', path)
+    @staticmethod
+    def get_fields(request):
+        """Returns the list of field names requested through the fields query
+        parameter (comma-separated); None if all fields are wanted.
+        """
 
-        if __name__ == "__main__":
-            try:
-                app.run(host='0.0.0.0', port=8001)
-            finally:
-                manager.handle_shutdown()
+        value = request.args.get('fields')
+        if value == None:
+            return None
 
-        </code>
-    """
+        return [field for field in value.split(',') if len(field) > 0]
 
-    locks = {}
-    records = {}
-    collection_configs = {}
+    @staticmethod
+    def wants_page(request):
+        args = request.args
+        return args.has_key('limit') or args.has_key('offset') or \
+            args.has_key('cursor')
 
-    def __init__(self):
-        #self.data = []
-        pass
-    
     @staticmethod
-    def init(collection_config_list):
-        """Initializes the manager with a list of configuration for each 
-        collection that it will manage.
+    def get_sorted_keys(collection):
+        """Returns the logical keys of the collection in ascending order. The 
+        sorted list is reused until the collection changes.
+        """
+
+        version = LazyManager.versions.get(collection, 0)
+        cached = LazyManager.sorted_keys.get(collection)
+        if cached != None and cached[0] == version:
+            return cached[1]
+
+        keys = sorted(LazyManager.records[collection].keys())
+        LazyManager.sorted_keys[collection] = (version, keys)
+        return keys
+
+    @staticmethod
+    def get_page(request, collection, entries=None):
+        """Extracts a page of entries ordered by the id_field, as described by
+        the limit, offset and cursor query parameters. The cursor is the 
+        X-Next-Cursor header value returned with the previous page.
 
         Args:
-            collection_config_list: list of collection configuration
+            request: Request object associated with the HTTP request
+            collection: collection name
+            entries: optional subset of the collection's entries to page 
+                through, e.g. the result of a filter
 
         Returns:
-            None
+            tuple of ordered dictionary of entries and the cursor of the next
+            page (None on the last page); None if the parameters are invalid
         """
 
-        for config in collection_config_list:
-            LazyManager.collection_configs[config.name] = config
-            LazyManager.locks[config.name] = threading.RLock()
-            LazyManager.records[config.name] = DataHelper.load_data(config.data_file)
+        try:
+            limit = int(request.args.get('limit', -1))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return None
 
-        atexit.register(LazyManager.handle_shutdown)
+        if offset < 0:
+            return None
 
-    def get_records(self):
-        return LazyManager.records
+        if entries == None:
+            entries = LazyManager.records[collection]
+            keys = LazyManager.get_sorted_keys(collection)
+        else:
+            keys = sorted(entries.keys())
 
+        start = 0
+        cursor = request.args.get('cursor')
+        if cursor != None:
+            try:
+                last_key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            except (TypeError, ValueError):
+                return None
+            start = bisect.bisect_right(keys, last_key)
+
+        start += offset
+        end = len(keys) if limit < 0 else min(start + limit, len(keys))
+
+        page = collections.OrderedDict()
+        for key in keys[start:end]:
+            entry = entries.get(key)
+            if entry != None:
+                page[key] = entry
+
+        next_cursor = None
+        if end < len(keys) and end > start:
+            next_cursor = base64.urlsafe_b64encode(json.dumps(keys[end - 1]))
 
-    def get_data_entries(self, request, collection, entry_id):
+        return page, next_cursor
+
+    def get_data_entries(self, request, collection, entry_id, filter_list=None):
         """Retrieves the entries associated with the specified collection.
 
         Args:
             request: Request object associated with the HTTP request
             collection: collection name
             entry_id: ID to find; needle in haystack
+            filter_list: fields that may be used as filters in the query 
+                string (see get_filters); defaults to the collection's 
+                filter_fields and indexed fields
 
         Returns:
             HTTP response containing the list of entries as JSON content
         """
 
+        name = collection
         collection = self.get_records()[collection]
 
         status = 200
         content = None
+        next_cursor = None
+
+        fields = LazyManager.get_fields(request)
 
         if entry_id == None or len(entry_id) == 0:                
-            content = json.dumps(collection)
+            if filter_list == None:
+                filter_list = LazyManager.get_filter_fields(name)
+
+            try:
+                filters = LazyManager.get_filters(request, filter_list)
+            except ValueError:
+                return Response(status = 400)
+
+            # Select entries under the read lock; the selection is a private
+            # dictionary, so it is serialized after the lock is released
+            entries = None
+            paged = LazyManager.wants_page(request)
+            if len(filters) > 0 or paged:
+                with LazyManager.reading(name):
+                    if len(filters) > 0:
+                        entries = LazyManager.filter_entries(name, filters)
+
+                    if paged:
+                        page = LazyManager.get_page(request, name, entries)
+                        if page == None:
+                            return Response(status = 400)
+                        entries, next_cursor = page
+
+            if entries == None:
+                if LazyManager.wants_stream(request, name):
+                    snapshot = LazyManager.get_snapshot(name)[1]
+                    content = DataHelper.iter_json(snapshot, fields=fields)
+                elif fields != None:
+                    snapshot = LazyManager.get_snapshot(name)[1]
+                    content = DataHelper.codec.dumps(
+                        DataHelper.project_all(snapshot, fields))
+                else:
+                    content = LazyManager.get_serialized(name)
+            elif LazyManager.wants_stream(request, name) and not paged:
+                content = DataHelper.iter_json(entries, fields=fields)
+            elif paged:
+                # Pages are ordered; not every codec keeps OrderedDict order
+                content = ''.join(DataHelper.iter_json_items(entries.items(), 
+                                                             fields=fields))
+            else:
+                content = DataHelper.codec.dumps(
+                    DataHelper.project_all(entries, fields))
         else:
-            entry = next((i for k,i in collection.iteritems() 
-                if i['__id__'] == entry_id), None)
+            entry = LazyManager.lookup_entry(name, entry_id)
             
             if entry == None:
                 status = 404
             else:
-                content = json.dumps(entry)
+                content = DataHelper.codec.dumps(DataHelper.project(entry, fields))
 
         #resp = content
         resp = Response(response=content,
                        status=status,
                        mimetype="application/json")
 
+        if next_cursor != None:
+            resp.headers['X-Next-Cursor'] = next_cursor
+
         return resp
 
+    @staticmethod
+    def lookup_entry(collection, entry_id):
+        """Finds the entry of a collection having the specified internal ID.
+
+        Args:
+            collection: collection name
+            entry_id: internal ID (__id__) of the entry
+
+        Returns:
+            the stored entry, which must not be modified; None if not found
+        """
+
+        with LazyManager.reading(collection):
+            key = LazyManager.find_key(collection, entry_id)
+            return None if key == None else LazyManager.records[collection][key]
+
+    @staticmethod
+    def remove_entry(collection, entry_id):
+        """Deletes the entry of a collection having the specified internal ID.
+
+        Args:
+            collection: collection name
+            entry_id: internal ID (__id__) of the entry
+
+        Returns:
+            HTTP status; 200 for success; otherwise, 404
+        """
+
+        entries = LazyManager.records[collection]
+        with LazyManager.writing(collection):
+            key = LazyManager.find_key(collection, entry_id)
+            if key == None:
+                return 404
+
+            LazyManager.update_field_indexes(collection, key, entries[key], None)
+            del entries[key]
+            LazyManager.unindex_entry(collection, entry_id)
+            LazyManager.log_operation(collection, 'del', key)
+
+        return 200
+
+    @staticmethod
+    def replace_entry(collection, entry_id, entry):
+        """Replaces the entry of a collection having the specified internal ID.
+        The new entry keeps the internal ID and logical key of the old one.
+
+        Args:
+            collection: collection name
+            entry_id: internal ID (__id__) of the entry
+            entry: new contents of the entry
+
+        Returns:
+            HTTP status; 200 for success; otherwise, 404
+        """
+
+        entries = LazyManager.records[collection]
+        with LazyManager.writing(collection):
+            key = LazyManager.find_key(collection, entry_id)
+            if key == None:
+                return 404
+
+            logger.debug('replacing %s entry %s', collection, entry_id)
+            entry['__id__'] = entries[key]['__id__'] 
+            LazyManager.update_field_indexes(collection, key, entries[key], entry)
+            entries[key] = entry
+            LazyManager.log_operation(collection, 'put', key, entry)
+
+        return 200
+
     def delete_data_entry(self, request, collection, entry_id):
         """Deletes the data entry in the specified collection with
         the corresponding entry_id
@@ -326,21 +2977,13 @@ class LazyManager:
             HTTP response; 200 for success; otherwise, 404 
         """
 
-        collection = self.get_records()[collection]
-
         status = 200
         content = None
 
         if entry_id == None or len(entry_id) == 0:                
             status = 404
         else:
-            key = next((k for k,i in collection.iteritems() 
-                if i['__id__'] == entry_id), None)
-            
-            if key == None:
-                status = 404
-            else:
-                del collection[key]
+            status = LazyManager.remove_entry(collection, entry_id)
 
         #resp = content
         resp = Response(response=content,
@@ -362,39 +3005,73 @@ class LazyManager:
             HTTP response; 200 for success; otherwise, 404 
         """
 
-        entry = request.get_json(force=True, silent=True)
+        entry = LazyManager.parse_body(request)
         if entry == None:
             return Response(status = 400)
 
-        collection = self.get_records()[collection]
-
         status = 200
 
         if entry_id == None or len(entry_id) == 0:                
             status = 404
         else:
-            key = next((k for k,i in collection.iteritems() 
-                if i['__id__'] == entry_id), None)
-            
-            if key == None:
-                status = 404
-            else:
-                pprint.pprint(entry)
-                entry['__id__'] = collection[key]['__id__'] 
-                collection[key] = entry
+            status = LazyManager.replace_entry(collection, entry_id, entry)
 
         #resp = content
         resp = Response(status=status)
 
         return resp
 
+    @staticmethod
+    def parse_body(request):
+        """Parses the JSON body of a request regardless of its content type.
+
+        Args:
+            request: Request object associated with the HTTP request
+
+        Returns:
+            parsed body; None if the body is not valid JSON
+        """
+
+        try:
+            return DataHelper.codec.loads(request.get_data())
+        except ValueError:
+            return None
+
+    @staticmethod
+    def wants_summary(request):
+        value = request.args.get('summary')
+        return value != None and value.lower() not in ('0', 'false', 'no')
+
+    @staticmethod
+    def wants_atomic(request):
+        value = request.args.get('atomic')
+        return value != None and value.lower() not in ('0', 'false', 'no')
+
+    @staticmethod
+    def summarize(results):
+        """Condenses the results of DataHelper.add_entries into counts and the
+        internal IDs of the stored entries (None for rejected ones).
+        """
+
+        statuses = [status for status, result in results]
+        return {
+            'count': len(results),
+            'added': statuses.count(201),
+            'updated': statuses.count(200),
+            'failed': statuses.count(400) + statuses.count(424),
+            'ids': [result['__id__'] if status < 400 else None 
+                for status, result in results],
+        }
+
     def add_update_data_entries(self, request, collection):
         """Adds or updates entries in the collection associated with the 
         specified collection. 
         
         Entries will be extracted from the HTTP request body as JSON-encoded 
         content. The body is expected to contain a single dictionary or a list of
-        dictionaries.
+        dictionaries. For a list, the summary query parameter makes the 
+        response report counts and internal IDs instead of echoing the entries,
+        and the atomic query parameter stores either all entries or none.
         
         Args:
             request: Request object associated with the HTTP request
@@ -406,22 +3083,32 @@ class LazyManager:
 
         records = self.get_records()
 
-        entry = request.get_json(force=True, silent=True)
+        entry = LazyManager.parse_body(request)
         if entry == None:
             return Response(status = 400)
 
         if not isinstance(entry, list):
             status, content = DataHelper.add_entry(records, collection, entry)
         else:
-            entries = entry
-            contents = [] 
+            atomic = LazyManager.wants_atomic(request)
+            if atomic and \
+                    LazyManager.collection_configs[collection].shards > 1:
+                return Response(response=DataHelper.codec.dumps(
+                                    {'error': 'atomic batches are not '
+                                              'supported on sharded collections'}),
+                               status=400,
+                               mimetype="application/json")
 
-            for entry in entries:
-                status, txt = DataHelper.add_entry(records, collection, entry)
-                contents.append(txt)
+            results = DataHelper.add_entries(records, collection, entry, atomic)
 
             status = 200
-            content = '[' + ','.join(contents) + ']'
+            if atomic and any(s == 400 for s, result in results):
+                status = 400
+            if LazyManager.wants_summary(request):
+                content = DataHelper.codec.dumps(LazyManager.summarize(results))
+            else:
+                content = DataHelper.codec.dumps(
+                    [result for s, result in results])
 
         resp = Response(response=content,
                        status=status,
@@ -429,6 +3116,133 @@ class LazyManager:
 
         return resp
 
+    def get_conditional(self, request, collection, entry_id):
+        """Retrieves entries like get_data_entries, adding ETag and 
+        Last-Modified headers and answering 304 Not Modified when the client's
+        cached copy is still current.
+
+        Args:
+            request: Request object associated with the HTTP request
+            collection: collection name
+            entry_id: ID (if any) of specific collection entry
+
+        Returns:
+            HTTP response
+        """
+
+        validators = LazyManager.get_validators(collection, entry_id)
+        if validators == None:
+            return self.get_data_entries(request, collection, entry_id)
+
+        etag, modified = validators
+        if len(request.query_string) > 0:       # each query is its own variant
+            etag += '-%08x' % (zlib.crc32(request.query_string) & 0xffffffff)
+
+        if LazyManager.is_not_modified(request, etag, modified):
+            resp = Response(status=304)
+        else:
+            resp = self.get_data_entries(request, collection, entry_id)
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        resp.last_modified = datetime.utcfromtimestamp(int(modified))
+        return resp
+
+    def process_batch(self, request):
+        """Executes a list of operations, possibly across collections, sent as
+        the JSON body of a single request to /<prefix>/_batch. Each operation
+        is a dictionary of the form:
+
+            {"op": "insert", "collection": "temperature", "entry": {...}}
+            {"op": "update", "collection": "temperature", "id": "<__id__>",
+                "entry": {...}}
+            {"op": "delete", "collection": "temperature", "id": "<__id__>"}
+            {"op": "get", "collection": "temperature", "id": "<__id__>"}
+
+        Operations are executed in order and independently of each other.
+
+        Args:
+            request: Request object associated with the HTTP request
+
+        Returns:
+            HTTP response containing a list with one {"status": ..., 
+            "body": ...} result per operation
+        """
+
+        operations = LazyManager.parse_body(request)
+        if not isinstance(operations, list):
+            return Response(status = 400)
+
+        results = []
+        for operation in operations:
+            try:
+                results.append(LazyManager.execute_operation(operation))
+            except Exception:
+                # Earlier operations are already stored; report this one
+                # rather than failing the whole batch
+                logger.exception('batch operation failed')
+                results.append({'status': 500, 
+                                'body': {'error': 'internal error'}})
+
+        return Response(response=DataHelper.codec.dumps(results),
+                       status=200,
+                       mimetype="application/json")
+
+    @staticmethod
+    def execute_operation(operation):
+        """Executes a single operation of a batch request.
+
+        Args:
+            operation: operation dictionary, see process_batch
+
+        Returns:
+            result dictionary with the HTTP status of the operation and, where
+            applicable, the resulting entry or an error
+        """
+
+        if not isinstance(operation, dict):
+            return {'status': 400, 'body': {'error': 'invalid operation'}}
+
+        op = operation.get('op')
+        collection = operation.get('collection')
+        entry_id = operation.get('id')
+        entry = operation.get('entry')
+
+        if not isinstance(collection, basestring):
+            return {'status': 400, 'body': {'error': 'invalid collection'}}
+        if not LazyManager.collection_configs.has_key(collection):
+            return {'status': 404, 'body': {'error': 'unknown collection'}}
+        LazyManager.refresh(collection)
+
+        if op == 'insert':
+            if not isinstance(entry, dict):
+                return {'status': 400, 'body': {'error': 'missing entry'}}
+
+            status, result = DataHelper.add_entries(LazyManager.records, 
+                                                    collection, [entry])[0]
+            return {'status': status, 'body': result}
+
+        if not isinstance(entry_id, basestring) or len(entry_id) == 0:
+            return {'status': 400, 'body': {'error': 'missing id'}}
+
+        if op == 'get':
+            entry = LazyManager.lookup_entry(collection, entry_id)
+            if entry == None:
+                return {'status': 404}
+            return {'status': 200, 'body': entry}
+
+        if op == 'delete':
+            return {'status': LazyManager.remove_entry(collection, entry_id)}
+
+        if op == 'update':
+            if not isinstance(entry, dict):
+                return {'status': 400, 'body': {'error': 'missing entry'}}
+            return {'status': LazyManager.replace_entry(collection, entry_id, 
+                                                        entry)}
+
+        return {'status': 400, 'body': {'error': 'unknown op'}}
+
     def process_request(self, request, collection, entry_id):
         """Process a REST operation on the specified collection. Operation
         will depend on the HTTP request method made. 
@@ -442,10 +3256,18 @@ class LazyManager:
             corresponding HTTP response
         """
 
+        if collection == LazyManager.BATCH_COLLECTION and \
+                request.method == 'POST':
+            return self.process_batch(request)
+
         if not LazyManager.collection_configs.has_key(collection):
             return Response(status = 404)
+        LazyManager.refresh(collection)
 
-        if request.method == 'GET' or request.method == 'OPTIONS' :
+        if request.method == 'GET':
+            return self.get_conditional(request, collection, entry_id)
+
+        if request.method == 'OPTIONS':
             return self.get_data_entries(request, collection, entry_id)
 
         if request.method == 'DELETE':
@@ -462,35 +3284,204 @@ class LazyManager:
 
 
     @staticmethod
-    def handle_url_single_filter(collection, req, resp, filter_list):
+    def get_filter_fields(collection):
+        """Returns the fields a collection may be filtered by: its 
+        filter_fields followed by its indexed fields.
+        """
+
         config = LazyManager.collection_configs[collection]
+        fields = list(config.filter_fields or [])
+        fields += sorted(field for field in (config.indexes or {}) 
+                         if field not in fields)
+        return fields
+
+    @staticmethod
+    def get_filters(request, filter_list):
+        """Extracts the filters present in the query string. A filter is either
+        field=value for equality or field__op=operand where op is one of:
+
+            gt, gte, lt, lte    field__gt=30
+            between             field__between=10,20 (inclusive)
+            in                  field__in=kitchen,attic
+
+        Args:
+            request: Request object associated with the HTTP request
+            filter_list: fields that may be used as filters
+
+        Returns:
+            list of (field, op, operand) tuples
+
+        Raises:
+            ValueError: if an operand is malformed
+        """
+
+        filters = []
+        for filter_key in filter_list or []:
+            value = request.args.get(filter_key)
+            if value:
+                filters.append((filter_key, 'eq', value))
+
+            for op in LazyManager.FILTER_OPS:
+                value = request.args.get(filter_key + '__' + op)
+                if value == None:
+                    continue
+
+                if op == 'in':
+                    operand = value.split(',')
+                elif op == 'between':
+                    bounds = value.split(',', 1)
+                    if len(bounds) != 2:
+                        raise ValueError('between expects two values')
+                    operand = tuple(DataHelper.parse_value(b) for b in bounds)
+                else:
+                    operand = DataHelper.parse_value(value)
+
+                filters.append((filter_key, op, operand))
+
+        return filters
+
+    @staticmethod
+    def filter_entries(collection, filters):
+        """Selects the entries of a collection matching all of the specified
+        filters. Indexed fields are looked up in their index; only the 
+        resulting candidates are scanned.
+
+        Args:
+            collection: collection name
+            filters: list of (field, op, operand) tuples as returned by 
+                get_filters
+
+        Returns:
+            dictionary of matching entries keyed by their id_field value
+        """
 
-        new_entries = {}                                   # new entries  
-        for filter_key in filter_list:
-            value = req.args.get(filter_key)    
-            if not value:
+        entries = LazyManager.records[collection]
+        indexes = LazyManager.field_indexes.get(collection, {})
+
+        # Narrow down candidates with the indexed filters
+        candidates = None
+        for field, op, operand in filters:
+            if not indexes.has_key(field):
                 continue
 
-            for txt in resp.response:                          # for all response texts 
-                dictionary = json.loads(txt)                   # convert to dictionary of __id__->entry
+            keys = indexes[field].lookup(op, operand)
+            if keys == None:
+                continue
+            candidates = keys if candidates == None else candidates & keys
 
-                for k, entry in dictionary.iteritems():        # Traverse dictionary of entries
-                    if entry[filter_key] == value:             # Filter
-                        new_entries[entry[config.id_field]] = entry
+        if candidates == None:
+            candidates = entries.keys()
 
-            resp = Response(response=json.dumps(new_entries),
-                           status=200,
-                           mimetype="application/json")
-        return resp
+        matches = {}
+        for key in candidates:
+            entry = entries.get(key)
+            if entry == None:
+                continue
+
+            for field, op, operand in filters:
+                if not entry.has_key(field) or \
+                        not DataHelper.compare(entry[field], op, operand):
+                    break
+            else:
+                matches[key] = entry
+
+        return matches
+
+    @staticmethod
+    def handle_url_single_filter(collection, req, resp, filter_list):
+        """Filters a full-collection response by the fields in filter_list 
+        that appear in the query string (see get_filters), combining them with
+        AND. Filtering runs against the stored entries; the body of resp is 
+        not re-parsed.
+
+        Args:
+            collection: collection name
+            req: Request object associated with the HTTP request
+            resp: unfiltered response, returned as is if no filter applies
+            filter_list: fields that may be used as filters
+
+        Returns:
+            HTTP response containing the matching entries as JSON content
+        """
+
+        try:
+            filters = LazyManager.get_filters(req, filter_list)
+        except ValueError:
+            return Response(status = 400)
+
+        if len(filters) == 0:
+            return resp
+
+        with LazyManager.reading(collection):
+            new_entries = LazyManager.filter_entries(collection, filters)
+        return Response(response=DataHelper.codec.dumps(new_entries),
+                       status=200,
+                       mimetype="application/json")
 
 
     @staticmethod
     def handle_shutdown():
-        LazyManager.save()
+        started = time.time()
+        deadline = LazyManager.save_deadline
+        LazyManager.stop_snapshots(deadline)
+
+        # A snapshot still running is waited on by save, within the deadline
+        if deadline != None:
+            deadline = max(deadline - (time.time() - started), 0)
+        LazyManager.save(deadline)
 
     @staticmethod
-    def save():
+    def save(deadline=None):
+        """Saves every collection changed since its last save, writing the
+        collections concurrently. Unchanged collections are skipped, while
+        those in the middle of a save are waited on.
+
+        Args:
+            deadline: optional number of seconds to wait for the saves; 
+                collections still unsaved by then are reported and left to
+                finish in the background
+
+        Returns:
+            list of names of collections that were not saved
+        """
+
+        started = time.time()
+        results = {}
+
+        def save_collection(name):
+            try:
+                with LazyManager.save_locks[name]:
+                    if LazyManager.dirty.get(name, 0) == 0:
+                        results[name] = True    # saved by the save we waited on
+                    else:
+                        results[name] = LazyManager.compact_locked(name)
+            except Exception:
+                logger.exception('failed to save %s', name)
+                results[name] = False
+
+        threads = []
         for name, config in LazyManager.collection_configs.iteritems():
-             print config.data_file
-             DataHelper.save_data(config.data_file, LazyManager.records[config.name])
+            if (LazyManager.dirty.get(name, 0) == 0 
+                    and not LazyManager.save_locks[name].locked()):
+                continue                        # nothing changed since last save
+
+            thread = threading.Thread(target=save_collection, args=(name,))
+            thread.daemon = True                # do not hold up a timed-out exit
+            thread.start()
+            threads.append((name, thread))
+
+        expiry = None if deadline == None else started + deadline
+        for name, thread in threads:
+            thread.join(None if expiry == None 
+                        else max(expiry - time.time(), 0))
+
+        unsaved = [name for name, thread in threads 
+                   if not results.get(name, False)]
+        if len(unsaved) > 0:
+            logger.warning('unsaved collections: %s', ', '.join(sorted(unsaved)))
+        elif len(threads) > 0:
+            logger.info('saved %d collections in %.3fs', len(threads), 
+                        time.time() - started)
+
+        return unsaved
 
@@ -0,0 +1,1160 @@
+"""Tests for rest_api_helper
+
+    python -m unittest discover tests
+"""
+
+import collections, json, logging, multiprocessing, os, shutil, StringIO
+import sys, tempfile, threading, time, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask, Response, request
+
+from rest_api_helper import LazyManager, CollectionConfig, DataHelper
+from rest_api_helper import SqliteBackend, LazyEntries, ReadWriteLock
+from rest_api_helper import SortedIndex
+
+
+class ManagerTestCase(unittest.TestCase):
+    """Runs each test against a fresh LazyManager and data directory."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.reset()
+
+    def tearDown(self):
+        self.reset()
+        shutil.rmtree(self.data_dir)
+
+    def reset(self):
+        LazyManager.stop_snapshots()
+        for journal_files in LazyManager.journals.values():
+            for journal_file in journal_files:
+                if journal_file != None:
+                    journal_file.close()
+
+        for name, value in vars(LazyManager).items():
+            if isinstance(value, (dict, set)) and not name.isupper():
+                value.clear()
+        LazyManager.save_deadline = None
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def init(self, **options):
+        options.setdefault('journal_file', self.path('t.log'))
+        config = CollectionConfig('t', 'id', self.path('t.json'), **options)
+        LazyManager.init([config], workers=1)
+        return config
+
+    def add(self, entry):
+        return DataHelper.add_entry(LazyManager.records, 't', entry)
+
+    def update(self, entry):
+        """Replaces the stored entry having the same id"""
+        entry['__id__'] = LazyManager.records['t'][entry['id']]['__id__']
+        return self.add(entry)
+
+    def client(self):
+        app = Flask(__name__)
+        manager = LazyManager()
+
+        @app.route('/api/<collection>', defaults={'entry_id': None}, 
+                   methods=['POST', 'GET', 'PUT'])
+        @app.route('/api/<collection>/<entry_id>', 
+                   methods=['PUT', 'GET', 'DELETE'])
+        def handle_api(collection, entry_id):
+            return manager.process_request(request, collection, entry_id)
+
+        return app.test_client()
+
+
+class IdIndexTest(ManagerTestCase):
+
+    def test_index_follows_writes(self):
+        self.init()
+        client = self.client()
+        response = client.post('/api/t', content_type='application/json',
+                               data=json.dumps({'id': 'a', 'value': 1}))
+        internal_id = json.loads(response.data)['__id__']
+        self.assertEqual(LazyManager.find_key('t', internal_id), u'a')
+
+        response = client.put('/api/t/' + internal_id,
+                              content_type='application/json',
+                              data=json.dumps({'id': 'a', 'value': 2}))
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/api/t/' + internal_id)
+        self.assertEqual(json.loads(response.data)['value'], 2)
+
+        self.assertEqual(client.delete('/api/t/' + internal_id).status_code,
+                         200)
+        self.assertEqual(LazyManager.find_key('t', internal_id), None)
+        self.assertEqual(LazyManager.id_indexes['t'], {})
+        self.assertEqual(client.get('/api/t/' + internal_id).status_code, 404)
+
+    def test_index_is_built_on_load(self):
+        DataHelper.save_data(self.path('t.json'),
+                             {'a': {'id': 'a', '__id__': 'x1'},
+                              'b': {'id': 'b', '__id__': 'x2'}})
+        self.init()
+        self.assertEqual(LazyManager.id_indexes['t'], {'x1': 'a', 'x2': 'b'})
+        self.assertEqual(LazyManager.find_key('t', 'x2'), 'b')
+        self.assertEqual(LazyManager.find_key('t', 'x3'), None)
+
+
+class StreamTest(ManagerTestCase):
+
+    def test_iter_json_yields_chunks(self):
+        entries = dict(('k%d' % i, {'id': 'k%d' % i, 'value': i})
+                       for i in range(50))
+        chunks = list(DataHelper.iter_json(entries, chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(''.join(chunks)), entries)
+        self.assertEqual(list(DataHelper.iter_json({})), ['{}'])
+
+    def get(self, url):
+        with Flask(__name__).test_request_context(url):
+            return LazyManager().get_data_entries(request, 't', None)
+
+    def test_stream_snapshot_ignores_later_writes(self):
+        self.init()
+        self.add({'id': 'a'})
+        response = self.get('/api/t?stream=1')
+        self.assertTrue(response.is_streamed)
+
+        self.add({'id': 'b'})
+        self.assertEqual(json.loads(response.get_data()).keys(), [u'a'])
+
+    def test_streamed_collection(self):
+        self.init(stream=True)
+        self.add({'id': 'a', 'value': 1})
+        self.add({'id': 'b', 'value': 2})
+
+        response = self.get('/api/t')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(json.loads(response.get_data()),
+                         LazyManager.records['t'])
+
+        response = self.get('/api/t?stream=0')
+        self.assertFalse(response.is_streamed)
+        self.assertEqual(json.loads(response.get_data()),
+                         LazyManager.records['t'])
+
+
+class BodyCacheTest(ManagerTestCase):
+
+    def test_writes_invalidate_cached_body(self):
+        self.init()
+        self.add({'id': 'a', 'value': 1})
+        client = self.client()
+
+        body = LazyManager.get_serialized('t')
+        self.assertTrue(LazyManager.get_serialized('t') is body)
+        self.assertEqual(json.loads(client.get('/api/t').data),
+                         json.loads(body))
+
+        version = LazyManager.versions['t']
+        internal_id = LazyManager.records['t']['a']['__id__']
+        client.put('/api/t/' + internal_id, content_type='application/json',
+                   data=json.dumps({'id': 'a', 'value': 2}))
+        self.assertTrue(LazyManager.versions['t'] > version)
+        self.assertEqual(json.loads(client.get('/api/t').data)['a']['value'],
+                         2)
+
+        self.add({'id': 'b'})
+        self.assertEqual(sorted(json.loads(client.get('/api/t').data)),
+                         [u'a', u'b'])
+
+        client.delete('/api/t/' + internal_id)
+        self.assertEqual(json.loads(client.get('/api/t').data).keys(),
+                         [u'b'])
+
+
+class ConditionalGetTest(ManagerTestCase):
+
+    def test_collection_etag(self):
+        self.init()
+        self.add({'id': 'a'})
+        client = self.client()
+
+        response = client.get('/api/t')
+        etag = response.headers['ETag']
+        self.assertTrue('Last-Modified' in response.headers)
+
+        response = client.get('/api/t', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = client.get('/api/t?fields=id',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        self.add({'id': 'b'})
+        response = client.get('/api/t', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_entry_etag(self):
+        self.init()
+        self.add({'id': 'a'})
+        self.add({'id': 'b'})
+        internal_id = LazyManager.records['t']['a']['__id__']
+        client = self.client()
+
+        etag = client.get('/api/t/' + internal_id).headers['ETag']
+        self.assertEqual(self.update({'id': 'b', 'value': 1})[0], 200)
+        response = client.get('/api/t/' + internal_id,
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.update({'id': 'a', 'value': 1})
+        response = client.get('/api/t/' + internal_id,
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        response = client.get('/api/t/missing',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+
+    def test_if_modified_since(self):
+        self.init()
+        self.add({'id': 'a'})
+        client = self.client()
+
+        modified = client.get('/api/t').headers['Last-Modified']
+        response = client.get('/api/t',
+                              headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get('/api/t', headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+
+class PaginationTest(ManagerTestCase):
+
+    def test_cursor_round_trip(self):
+        self.init()
+        for i in range(7):
+            self.add({'id': 'k%d' % i})
+        client = self.client()
+
+        keys = []
+        url = '/api/t?limit=3'
+        while url != None:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data,
+                              object_pairs_hook=collections.OrderedDict)
+            keys += page.keys()
+
+            cursor = response.headers.get('X-Next-Cursor')
+            url = None if cursor == None else \
+                '/api/t?limit=3&cursor=' + cursor
+
+        self.assertEqual(keys, ['k%d' % i for i in range(7)])
+
+    def test_cursor_survives_inserts(self):
+        self.init()
+        for key in ('a', 'c', 'e'):
+            self.add({'id': key})
+        client = self.client()
+
+        cursor = client.get('/api/t?limit=2').headers['X-Next-Cursor']
+        self.add({'id': 'b'})
+        self.add({'id': 'd'})
+        page = json.loads(client.get('/api/t?limit=2&cursor=' + cursor).data)
+        self.assertEqual(sorted(page), [u'd', u'e'])
+
+    def test_offset_and_invalid_parameters(self):
+        self.init(filter_fields=['loc'])
+        for i in range(5):
+            self.add({'id': 'k%d' % i, 'loc': 'x' if i % 2 else 'y'})
+        client = self.client()
+
+        page = json.loads(client.get('/api/t?offset=3').data)
+        self.assertEqual(sorted(page), [u'k3', u'k4'])
+
+        response = client.get('/api/t?loc=y&limit=1&offset=1')
+        self.assertEqual(json.loads(response.data).keys(), [u'k2'])
+        self.assertTrue('X-Next-Cursor' in response.headers)
+
+        for query in ('limit=x', 'offset=-1', 'cursor=!!'):
+            self.assertEqual(client.get('/api/t?' + query).status_code, 400)
+
+
+class ProjectionTest(ManagerTestCase):
+
+    def test_fields_on_every_read_path(self):
+        self.init(filter_fields=['loc'])
+        self.add({'id': 'a', 'loc': 'x', 'value': 1, 'extra': 'z' * 100})
+        self.add({'id': 'b', 'loc': 'y', 'value': 2, 'extra': 'z' * 100})
+        internal_id = LazyManager.records['t']['a']['__id__']
+        client = self.client()
+
+        expected = {'a': {'id': 'a', 'value': 1}, 'b': {'id': 'b', 'value': 2}}
+        for query in ('', '&stream=1', '&limit=5'):
+            response = client.get('/api/t?fields=id,value' + query)
+            self.assertEqual(json.loads(response.data), expected)
+
+        response = client.get('/api/t?fields=value,missing&loc=y')
+        self.assertEqual(json.loads(response.data), {'b': {'value': 2}})
+
+        response = client.get('/api/t/%s?fields=loc' % internal_id)
+        self.assertEqual(json.loads(response.data), {'loc': 'x'})
+
+        self.assertTrue('extra' in LazyManager.records['t']['a'])
+        response = client.get('/api/t')
+        self.assertTrue('extra' in json.loads(response.data)['a'])
+
+
+class SnapshotTest(ManagerTestCase):
+
+    def test_snapshot_is_stable(self):
+        self.init()
+        self.add({'id': 'a', 'value': 1})
+
+        version, snapshot = LazyManager.get_snapshot('t')
+        self.assertTrue(LazyManager.get_snapshot('t')[1] is snapshot)
+
+        self.update({'id': 'a', 'value': 2})
+        self.add({'id': 'b'})
+        self.assertEqual(snapshot.keys(), [u'a'])
+        self.assertEqual(snapshot['a']['value'], 1)
+
+        new_version, new_snapshot = LazyManager.get_snapshot('t')
+        self.assertTrue(new_version > version)
+        self.assertEqual(sorted(new_snapshot), [u'a', u'b'])
+        self.assertEqual(new_snapshot['a']['value'], 2)
+
+    def test_writers_proceed_while_snapshot_is_read(self):
+        self.init()
+        for i in range(100):
+            self.add({'id': 'k%d' % i})
+
+        snapshot = LazyManager.get_snapshot('t')[1]
+        done = []
+
+        def write():
+            self.add({'id': 'new'})
+            done.append(1)
+
+        for key in snapshot:
+            if len(done) == 0:
+                thread = threading.Thread(target=write)
+                thread.start()
+                thread.join(10)
+        self.assertEqual(done, [1])
+        self.assertFalse('new' in snapshot)
+        self.assertTrue('new' in LazyManager.records['t'])
+
+
+class ReadWriteLockTest(unittest.TestCase):
+
+    def start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def wait_for(self, condition):
+        deadline = time.time() + 10
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_readers_do_not_block_each_other(self):
+        lock = ReadWriteLock()
+        inside = []
+        done = threading.Event()
+
+        def read():
+            with lock.read():
+                inside.append(1)
+                done.wait(10)
+
+        threads = [self.start(read) for i in range(3)]
+        self.wait_for(lambda: len(inside) == 3)
+        self.assertEqual(lock.readers, 3)
+
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lock.readers, 0)
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        lock = ReadWriteLock()
+        order = []
+        lock.acquire_read()
+
+        def write():
+            with lock.write():
+                order.append('write')
+
+        def read():
+            with lock.read():
+                order.append('read')
+
+        writer = self.start(write)
+        self.wait_for(lambda: lock.writers_waiting == 1)
+        reader = self.start(read)
+        time.sleep(0.05)
+        self.assertEqual(order, [])
+
+        lock.release_read()
+        writer.join(10)
+        reader.join(10)
+        self.assertEqual(order, ['write', 'read'])
+
+    def test_writer_reenters(self):
+        lock = ReadWriteLock()
+        with lock.write():
+            with lock.write():
+                with lock.read():
+                    self.assertTrue(lock.is_writing())
+            self.assertTrue(lock.is_writing())
+        self.assertFalse(lock.is_writing())
+        self.assertEqual(lock.writer, None)
+
+        acquired = []
+
+        def write():
+            with lock.write():
+                acquired.append(1)
+
+        self.start(write).join(10)
+        self.assertEqual(acquired, [1])
+
+
+class ConcurrentWriteTest(ManagerTestCase):
+
+    def test_concurrent_posts_are_all_recorded(self):
+        self.init()
+        client = self.client()
+        statuses = []
+
+        def insert(name):
+            for i in range(25):
+                response = client.post('/api/t',
+                    content_type='application/json',
+                    data=json.dumps({'id': '%s%d' % (name, i)}))
+                statuses.append(response.status_code)
+
+        threads = [threading.Thread(target=insert, args=(name,))
+                   for name in 'wxyz']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 100)
+        self.assertEqual(len(LazyManager.records['t']), 100)
+        self.assertEqual(len(LazyManager.id_indexes['t']), 100)
+
+        self.assertEqual(LazyManager.save(), [])
+        with open(self.path('t.json')) as data_file:
+            self.assertEqual(len(json.load(data_file)), 100)
+
+
+class SnapshotFailureTest(ManagerTestCase):
+
+    def fail_rename_once(self):
+        rename = os.rename
+        calls = []
+
+        def failing_rename(source, target):
+            if target == self.path('t.json') and len(calls) == 0:
+                calls.append(target)
+                raise OSError('rename failed')
+            return rename(source, target)
+
+        os.rename = failing_rename
+        self.addCleanup(setattr, os, 'rename', rename)
+        return calls
+
+    def test_failed_compaction_stays_dirty(self):
+        self.init()
+        self.add({'id': 'a', 'value': 1})
+        calls = self.fail_rename_once()
+
+        self.assertFalse(LazyManager.compact('t'))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(LazyManager.dirty['t'] > 0)
+
+        self.assertEqual(LazyManager.save(), [])
+        with open(self.path('t.json')) as data_file:
+            self.assertEqual(json.load(data_file).keys(), [u'a'])
+
+    def test_snapshot_thread_survives_failure(self):
+        self.init(snapshot_max_dirty=1)
+        calls = self.fail_rename_once()
+        self.add({'id': 'a', 'value': 1})
+
+        deadline = time.time() + 10
+        while len(calls) == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(calls), 1)
+
+        self.add({'id': 'b', 'value': 2})
+        while LazyManager.dirty['t'] > 0 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(LazyManager.snapshot_thread.is_alive())
+        self.assertEqual(LazyManager.dirty['t'], 0)
+        with open(self.path('t.json')) as data_file:
+            self.assertEqual(sorted(json.load(data_file)), [u'a', u'b'])
+
+
+class ShutdownTest(ManagerTestCase):
+
+    def test_deadline_bounds_running_snapshot(self):
+        save_data = DataHelper.save_data
+        started = []
+
+        def slow_save_data(*args, **kwargs):
+            started.append(True)
+            time.sleep(1.5)
+            return save_data(*args, **kwargs)
+
+        DataHelper.save_data = staticmethod(slow_save_data)
+        self.addCleanup(setattr, DataHelper, 'save_data', 
+                        staticmethod(save_data))
+
+        self.init(snapshot_max_dirty=1)
+        self.add({'id': 'a', 'value': 1})
+        deadline = time.time() + 10
+        while len(started) == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(started), 1)
+
+        LazyManager.save_deadline = 0.3
+        shutdown_started = time.time()
+        LazyManager.handle_shutdown()
+        self.assertTrue(time.time() - shutdown_started < 1.0)
+
+        with LazyManager.save_locks['t']:       # let the snapshot finish
+            pass
+
+
+class FieldIndexTest(ManagerTestCase):
+
+    def test_built_sorted_index_serves_updates(self):
+        entries = dict((str(i), {'id': str(i), 'value': (i * 7) % 10}) 
+                       for i in range(20))
+        DataHelper.save_data(self.path('t.json'), entries)
+        self.init(indexes={'value': 'sorted'})
+
+        index = LazyManager.field_indexes['t']['value']
+        self.assertEqual(index.pairs, sorted(index.pairs))
+        self.assertEqual(len(index.pairs), 20)
+        self.assertEqual(index.range(3, 4), set([u'9', u'2', u'19', u'12']))
+
+        self.add({'id': 'x', 'value': 3.5})
+        self.assertEqual(index.range(3, 4), 
+                         set([u'9', u'2', u'19', u'12', 'x']))
+
+
+class FilterTest(ManagerTestCase):
+
+    def get_ids(self, query):
+        response = self.client().get('/api/t?' + query)
+        self.assertEqual(response.status_code, 200)
+        return sorted(json.loads(response.data))
+
+    def test_indexed_field_is_filterable(self):
+        self.init(indexes={'loc': 'hash'})
+        for i in range(10):
+            self.add({'id': str(i), 'loc': 'k%d' % (i % 3)})
+
+        self.assertEqual(self.get_ids('loc=k1'), [u'1', u'4', u'7'])
+        self.assertEqual(len(self.get_ids('other=k1')), 10)
+
+    def test_operators_on_indexed_fields(self):
+        self.init(indexes={'value': 'sorted', 'loc': 'hash'})
+        for i in range(10):
+            self.add({'id': str(i), 'value': i, 'loc': 'k%d' % (i % 3)})
+
+        self.assertEqual(self.get_ids('value__gt=7'), [u'8', u'9'])
+        self.assertEqual(self.get_ids('value__lte=1'), [u'0', u'1'])
+        self.assertEqual(self.get_ids('value__between=3,5'), 
+                         [u'3', u'4', u'5'])
+        self.assertEqual(self.get_ids('loc__in=k0,k2'), 
+                         [u'0', u'2', u'3', u'5', u'6', u'8', u'9'])
+        self.assertEqual(self.get_ids('value__gte=5&loc=k1'), [u'7'])
+
+        response = self.client().get('/api/t?value__between=3')
+        self.assertEqual(response.status_code, 400)
+
+    def test_operators_follow_updates_and_types(self):
+        self.init(filter_fields=['other'], indexes={'value': 'sorted'})
+        self.add({'id': 'a', 'value': 10, 'other': 10})
+        self.add({'id': 'b', 'value': 20, 'other': 20})
+        self.add({'id': 'c', 'value': 'high', 'other': 'high'})
+        self.add({'id': 'd', 'value': True, 'other': True})
+
+        self.assertEqual(self.get_ids('value__gt=5'), [u'a', u'b'])
+        self.assertEqual(self.get_ids('other__gt=5'), [u'a', u'b'])
+        self.assertEqual(self.get_ids('value__gte=h'), [u'c'])
+        self.assertEqual(self.get_ids('value=20'), [u'b'])
+
+        self.assertEqual(self.update({'id': 'a', 'value': 30, 'other': 30})[0],
+                         200)
+        self.update({'id': 'b'})
+        self.assertEqual(self.get_ids('value__gt=5'), [u'a'])
+        self.assertEqual(self.get_ids('value__lt=30'), [])
+        self.assertEqual(self.get_ids('other__between=25,30'), [u'a'])
+
+    def test_sorted_index(self):
+        index = SortedIndex()
+        index.build([(3, 'c'), (1, 'a'), ('30', 's')])
+        index.add(30, 'n')
+        index.add(2, 'b')
+
+        self.assertEqual(index.range(1, 3, include_low=False),
+                         set(['b', 'c']))
+        self.assertEqual(index.lookup('lt', 3), set(['a', 'b']))
+        self.assertEqual(index.equal('30'), set(['n', 's']))
+
+        index.remove(2, 'b')
+        index.remove(2, 'missing')
+        self.assertEqual(index.lookup('between', (1, 3)), set(['a', 'c']))
+
+    def test_filters_combine_with_and(self):
+        self.init(filter_fields=['loc', 'value', 'on'])
+        for i in range(10):
+            self.add({'id': str(i), 'loc': 'k%d' % (i % 3), 'value': i % 2,
+                      'on': i < 5})
+
+        self.assertEqual(self.get_ids('loc=k1'), [u'1', u'4', u'7'])
+        self.assertEqual(self.get_ids('loc=k1&value=1'), [u'1', u'7'])
+        self.assertEqual(self.get_ids('loc=k1&value=1&on=true'), [u'1'])
+        self.assertEqual(self.get_ids('loc=k1&value=2'), [])
+        self.assertEqual(len(self.get_ids('loc=')), 10)
+
+    def test_filter_response(self):
+        self.init(filter_fields=['loc'])
+        self.add({'id': 'a', 'loc': 'x'})
+        self.add({'id': 'b', 'loc': 'y'})
+        unfiltered = Response('{}')
+
+        with Flask(__name__).test_request_context('/api/t?loc=y'):
+            response = LazyManager.handle_url_single_filter(
+                't', request, unfiltered, ['loc'])
+            self.assertEqual(json.loads(response.get_data()).keys(), [u'b'])
+
+        with Flask(__name__).test_request_context('/api/t?other=y'):
+            response = LazyManager.handle_url_single_filter(
+                't', request, unfiltered, ['loc'])
+            self.assertTrue(response is unfiltered)
+
+
+class BatchTest(ManagerTestCase):
+
+    def test_malformed_operations_get_their_own_status(self):
+        self.init()
+        operations = [
+            {'op': 'insert', 'collection': 't', 'entry': {'id': 'a'}},
+            {'op': 'insert', 'collection': ['t'], 'entry': {'id': 'b'}},
+            {'op': 'insert', 'collection': 't', 'entry': {'id': 'c', 
+                                                          '__id__': 5}},
+            {'op': 'insert', 'collection': 't', 'entry': {'id': ['d']}},
+            {'op': 'insert', 'collection': 't', 'entry': {'id': 'e'}},
+        ]
+
+        response = self.client().post('/api/_batch', 
+            data=json.dumps(operations), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in 
+                          json.loads(response.data)], [201, 400, 400, 400, 201])
+        self.assertEqual(sorted(LazyManager.records['t']), ['a', 'e'])
+
+
+class BulkWriteTest(ManagerTestCase):
+
+    def post(self, entries, query=''):
+        response = self.client().post('/api/t' + query,
+                                      content_type='application/json',
+                                      data=json.dumps(entries))
+        return response.status_code, json.loads(response.data)
+
+    def test_bulk_post(self):
+        self.init()
+        self.add({'id': 'a', 'value': 1})
+        internal_id = LazyManager.records['t']['a']['__id__']
+
+        status, body = self.post([{'id': 'a', '__id__': internal_id},
+                                  {'value': 2},
+                                  {'id': 'b'},
+                                  {'id': 'c'}])
+        self.assertEqual(status, 200)
+        self.assertEqual(body[0], {'id': 'a', '__id__': internal_id})
+        self.assertTrue('error' in body[1])
+        self.assertEqual(sorted(LazyManager.records['t']), [u'a', u'b', u'c'])
+        self.assertNotEqual(body[2]['__id__'], body[3]['__id__'])
+
+        self.reset()
+        self.init()
+        self.assertEqual(sorted(LazyManager.records['t']), [u'a', u'b', u'c'])
+        self.assertEqual(LazyManager.find_key('t', body[3]['__id__']), u'c')
+
+    def test_summary(self):
+        self.init()
+        self.add({'id': 'a'})
+        status, body = self.post([{'id': 'a', '__id__': 'wrong'},
+                                  {'id': 'b'}, {'id': 'c', '__id__': 'x3'}],
+                                 '?summary=1')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['count'], 3)
+        self.assertEqual((body['added'], body['updated'], body['failed']),
+                         (2, 0, 1))
+        self.assertEqual(body['ids'][0], None)
+        self.assertEqual(body['ids'][2], 'x3')
+        self.assertEqual(LazyManager.find_key('t', body['ids'][1]), u'b')
+
+
+class AtomicBatchTest(ManagerTestCase):
+
+    def post(self, entries):
+        response = self.client().post('/api/t?atomic=1', 
+                                      content_type='application/json',
+                                      data=json.dumps(entries))
+        return response.status_code, json.loads(response.data)
+
+    def test_rejected_batch_changes_nothing(self):
+        self.init()
+        self.add({'id': 'a', 'value': 1})
+        version = LazyManager.versions['t']
+
+        for batch in ([{'id': 'b'}, {'value': 2}],
+                      [{'id': 'b'}, {'id': 'a', '__id__': 'wrong'}],
+                      [{'id': 'b', '__id__': 'x1'},
+                       {'id': 'b', '__id__': 'x2'}]):
+            status, body = self.post(batch)
+            self.assertEqual(status, 400)
+            self.assertEqual(body[0]['error'], 'batch rejected')
+            self.assertTrue(body[1]['error'] != 'batch rejected')
+
+        self.assertEqual(LazyManager.records['t'].keys(), [u'a'])
+        self.assertEqual(LazyManager.versions['t'], version)
+
+        self.reset()
+        self.init()
+        self.assertEqual(LazyManager.records['t'].keys(), [u'a'])
+
+    def test_batch_is_journaled_as_one_record(self):
+        self.init()
+        status, body = self.post([{'id': 'a'}, {'id': 'b'}])
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(LazyManager.records['t']), [u'a', u'b'])
+
+        with open(self.path('t.log')) as journal_file:
+            lines = journal_file.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['op'], 'batch')
+
+        # A batch record torn by a crash is dropped as a whole
+        with open(self.path('t.log'), 'w') as journal_file:
+            journal_file.write(lines[0][:-10])
+        self.reset()
+        self.init()
+        self.assertEqual(LazyManager.records['t'], {})
+
+
+class ShardingTest(ManagerTestCase):
+
+    def test_existing_unsharded_data_file_is_rejected(self):
+        DataHelper.save_data(self.path('t.json'), {'a': {'id': 'a'}})
+        self.assertRaises(ValueError, self.init, shards=2)
+        self.assertFalse(os.path.exists(self.path('t.0.json')))
+
+    def test_atomic_batch_is_rejected(self):
+        self.init(shards=2)
+        entries = [{'id': str(i)} for i in range(4)]
+        self.assertRaises(ValueError, DataHelper.add_entries, 
+                          LazyManager.records, 't', entries, True)
+
+        response = self.client().post('/api/t?atomic=1', 
+            data=json.dumps(entries), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(LazyManager.records['t']), 0)
+
+
+class ParallelLoadTest(ManagerTestCase):
+
+    def configs(self):
+        return [CollectionConfig(name, 'id', self.path(name + '.json'),
+                                 journal_file=self.path(name + '.log'),
+                                 shards=shards)
+                for name, shards in (('a', 1), ('b', 1), ('s', 3))]
+
+    def test_workers_load_the_same_data(self):
+        LazyManager.init(self.configs(), workers=1)
+        for name in ('a', 'b', 's'):
+            for i in range(20):
+                DataHelper.add_entry(LazyManager.records, name,
+                                     {'id': '%s%d' % (name, i)})
+        self.assertEqual(LazyManager.save(), [])
+        DataHelper.add_entry(LazyManager.records, 's', {'id': 'journaled'})
+        expected = dict((name, dict(entries))
+                        for name, entries in LazyManager.records.items())
+
+        for workers in (1, 3):
+            self.reset()
+            LazyManager.init(self.configs(), workers=workers)
+            self.assertEqual(LazyManager.records, expected)
+            self.assertEqual(LazyManager.find_key(
+                's', expected['s']['journaled']['__id__']), 'journaled')
+            self.assertEqual(sorted(LazyManager.load_times), ['a', 'b', 's'])
+            self.assertTrue(LazyManager.startup_time >= 0)
+
+
+class LoggingTest(ManagerTestCase):
+
+    def capture(self, level=logging.DEBUG):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('rest_api_helper')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(level)
+        return records
+
+    def test_load_and_save_are_logged(self):
+        DataHelper.save_data(self.path('t.json'),
+                             {'a': {'id': 'a', '__id__': 'x1'}})
+        records = self.capture()
+        stdout = sys.stdout
+        sys.stdout = output = StringIO.StringIO()
+        try:
+            self.init()
+            self.update({'id': 'a', 'value': 1})
+            LazyManager.replace_entry('t', 'x1', {'id': 'a', 'value': 2})
+            LazyManager.save()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(output.getvalue(), '')
+        messages = [r.getMessage() for r in records]
+        self.assertTrue(any(m.startswith('loaded t: 1 entries')
+                            for m in messages))
+        self.assertTrue(any(m.startswith('saved t: 1 entries')
+                            for m in messages))
+        self.assertTrue('replacing t entry x1' in messages)
+
+    def test_failed_save_is_logged(self):
+        self.init()
+        self.add({'id': 'a'})
+        records = self.capture(logging.WARNING)
+
+        def failing_rename(source, target):
+            raise OSError('rename failed')
+
+        rename = os.rename
+        os.rename = failing_rename
+        try:
+            LazyManager.save()
+        finally:
+            os.rename = rename
+
+        self.assertTrue(len(records) > 0)
+        self.assertTrue(all(r.levelno >= logging.WARNING for r in records))
+        self.assertTrue(any(r.levelno == logging.ERROR for r in records))
+
+
+class DataFileTest(ManagerTestCase):
+
+    def test_undecodable_data_file_is_kept(self):
+        with open(self.path('t.json'), 'w') as data_file:
+            data_file.write('{"a": {"id": "a"}, "b": {"id"')
+
+        self.assertRaises(ValueError, self.init)
+        with open(self.path('t.json')) as data_file:
+            self.assertEqual(data_file.read(), '{"a": {"id": "a"}, "b": {"id"')
+
+    def test_empty_data_file_loads_empty(self):
+        open(self.path('t.json'), 'w').close()
+        self.init()
+        self.assertEqual(LazyManager.records['t'], {})
+
+
+class StorageFormatTest(ManagerTestCase):
+
+    entries = {u'a': {u'id': u'a', u'__id__': u'x1', u'name': u'caf\xe9',
+                      u'value': 1.5, u'tags': [1, None, True]}}
+
+    def test_round_trip(self):
+        for storage_format in DataHelper.STORAGE_FORMATS:
+            raw = DataHelper.encode_data(self.entries, storage_format)
+            self.assertEqual(DataHelper.decode_data(raw, storage_format),
+                             self.entries)
+            self.assertEqual(DataHelper.decode_data('', storage_format), {})
+
+        numbered = {7: {'id': 7, '__id__': 'x7'}}
+        for storage_format in ('msgpack', 'pickle'):
+            raw = DataHelper.encode_data(numbered, storage_format)
+            self.assertEqual(DataHelper.decode_data(raw, storage_format),
+                             numbered)
+
+        for storage_format in ('msgpack', 'pickle'):
+            self.assertRaises(ValueError, DataHelper.decode_data,
+                              '\xc1garbage', storage_format)
+
+    def test_convert_data(self):
+        path = self.path('t.json')
+        DataHelper.save_data(path, self.entries)
+
+        source_format = 'json'
+        for storage_format in ('msgpack', 'pickle', 'jsonl', 'json'):
+            target = self.path('t.' + storage_format + '.out')
+            self.assertTrue(DataHelper.convert_data(path, source_format,
+                                                    target, storage_format))
+            path, source_format = target, storage_format
+
+        with open(path, 'rb') as data_file:
+            self.assertEqual(json.load(data_file), self.entries)
+
+    def test_binary_collection_reloads(self):
+        for storage_format in ('msgpack', 'pickle'):
+            self.reset()
+            self.init(storage_format=storage_format)
+            self.add({'id': 'a', 'value': 1})
+            self.add({'id': 2, 'value': 2})
+            self.assertEqual(LazyManager.save(), [])
+
+            self.reset()
+            self.init(storage_format=storage_format)
+            entries = LazyManager.records['t']
+            self.assertEqual(sorted(entries.keys()), [2, u'a'])
+            self.assertEqual(entries[2]['value'], 2)
+            os.remove(self.path('t.json'))
+
+        self.assertRaises(ValueError, CollectionConfig, 't', 'id',
+                          self.path('t.json'), storage_format='xml')
+
+
+class JournalReplayTest(ManagerTestCase):
+
+    def test_replayed_key_matches_snapshot_key(self):
+        self.init()
+        self.add({'id': 5, 'value': 'old'})
+        LazyManager.compact('t')
+        internal_id = LazyManager.records['t'][5]['__id__']
+        LazyManager.replace_entry('t', internal_id, {'id': 5, 'value': 'new'})
+
+        self.reset()                            # crash before the next save
+        self.init()
+
+        entries = LazyManager.records['t']
+        self.assertEqual(entries.keys(), [u'5'])
+        self.assertEqual(entries[u'5']['value'], 'new')
+        self.assertEqual(LazyManager.id_indexes['t'], {internal_id: u'5'})
+
+
+class LazyEntriesTest(ManagerTestCase):
+
+    def open_entries(self, *entries):
+        with open(self.path('l.jsonl'), 'wb') as data_file:
+            for entry in entries:
+                prefix, text = LazyEntries.encode_line(entry['id'], entry)
+                data_file.write(prefix + text + '\n')
+        return LazyEntries(self.path('l.jsonl'))
+
+    def test_scan_decodes_on_access(self):
+        with open(self.path('l.jsonl'), 'wb') as data_file:
+            data_file.write('"a"\t"x1"\t{"id": "a", "__id__": "x1"}\n')
+            data_file.write('"b"\t"x2"\t{"id": "b", "__id__": "x2"}\n')
+            data_file.write('"c"\t"x3"\t{"id": "c"')    # torn write
+        entries = LazyEntries(self.path('l.jsonl'))
+
+        self.assertEqual(sorted(entries.keys()), [u'a', u'b'])
+        self.assertEqual(sorted(entries.take_internal_ids()),
+                         [(u'a', u'x1'), (u'b', u'x2')])
+        self.assertEqual(entries.cache, {})
+
+        self.assertEqual(entries['b']['__id__'], 'x2')
+        self.assertEqual(entries.cache.keys(), [u'b'])
+
+        entries.evict()
+        self.assertEqual(entries.cache, {})
+        self.assertEqual(entries['b']['id'], 'b')
+
+    def test_snapshot_keeps_later_changes(self):
+        entries = self.open_entries({'id': 'a', '__id__': 'x1'},
+                                    {'id': 'b', '__id__': 'x2'})
+        entries['b'] = {'id': 'b', '__id__': 'x2', 'value': 1}
+        entries['c'] = {'id': 'c', '__id__': 'x3', 'value': 1}
+        frozen = entries.freeze()
+
+        entries['c'] = {'id': 'c', '__id__': 'x3', 'value': 2}
+        entries['d'] = {'id': 'd', '__id__': 'x4'}
+        del entries['a']
+
+        new_offsets = entries.write_snapshot(frozen, self.path('l.jsonl'),
+                                             False)
+        entries.adopt(frozen, new_offsets)
+
+        self.assertEqual(sorted(entries.changed), [u'c', u'd'])
+        self.assertEqual(sorted(entries.keys()), [u'b', u'c', u'd'])
+        self.assertEqual(entries['b']['value'], 1)
+        self.assertEqual(entries['c']['value'], 2)
+
+        entries.evict()
+        self.assertEqual(entries['b']['value'], 1)
+
+        reopened = LazyEntries(self.path('l.jsonl'))
+        self.assertEqual(sorted(reopened.keys()), [u'a', u'b', u'c'])
+        self.assertEqual(reopened['c']['value'], 1)
+
+    def test_failed_rename_leaves_no_temporary_file(self):
+        entries = self.open_entries({'id': 'a', '__id__': 'x1'})
+        entries['b'] = {'id': 'b', '__id__': 'x2'}
+        frozen = entries.freeze()
+
+        def failing_rename(source, target):
+            raise OSError('rename failed')
+
+        rename = os.rename
+        os.rename = failing_rename
+        try:
+            result = entries.write_snapshot(frozen, self.path('l.jsonl'),
+                                            False)
+        finally:
+            os.rename = rename
+
+        self.assertEqual(result, None)
+        self.assertFalse(os.path.exists(self.path('l.jsonl.tmp')))
+        self.assertEqual(LazyEntries(self.path('l.jsonl')).keys(), [u'a'])
+        self.assertEqual(sorted(entries.keys()), [u'a', u'b'])
+
+    def test_lazy_collection_round_trip(self):
+        options = {'storage_format': 'jsonl', 'lazy': True}
+        self.init(**options)
+        self.add({'id': 'a', 'value': 1})
+        self.add({'id': 'b', 'value': 2})
+        self.assertTrue(LazyManager.compact('t'))
+
+        LazyManager.evict('t')
+        self.assertEqual(LazyManager.records['t'].cache, {})
+        self.assertEqual(LazyManager.records['t']['b']['value'], 2)
+
+        self.reset()
+        self.init(**options)
+        entries = LazyManager.records['t']
+        self.assertEqual(entries.changed, {})
+        self.assertEqual(sorted(entries.keys()), [u'a', u'b'])
+        self.assertEqual(entries['a']['value'], 1)
+
+
+class SqliteBackendTest(ManagerTestCase):
+
+    def init_shared(self, **options):
+        backend = SqliteBackend(self.path('store.db'), **options)
+        config = CollectionConfig('t', 'id', self.path('t.json'),
+                                  backend=backend, indexes={'loc': 'hash'})
+        LazyManager.init([config], workers=1)
+        return backend
+
+    def write(self, backend, operations):
+        """Writes through a backend the way another process would"""
+        backend.begin()
+        stamps = backend.write('t', operations)
+        backend.commit()
+        return stamps
+
+    def test_imports_data_file_once(self):
+        DataHelper.save_data(self.path('t.json'),
+                             {'a': {'id': 'a', '__id__': 'x1'}})
+        self.init_shared()
+        self.assertEqual(LazyManager.records['t'].keys(), [u'a'])
+
+        os.remove(self.path('t.json'))
+        self.reset()
+        self.init_shared()
+        self.assertEqual(LazyManager.records['t'].keys(), [u'a'])
+
+    def test_catches_up_with_other_writers(self):
+        backend = self.init_shared()
+        self.add({'id': 'a', 'loc': 'k1'})
+        self.add({'id': 'b', 'loc': 'k1'})
+        internal_id = LazyManager.records['t']['b']['__id__']
+
+        other = SqliteBackend(self.path('store.db'))
+        stamps = self.write(other, [
+            ('put', 'c', {'id': 'c', 'loc': 'k1', '__id__': 'x3'}),
+            ('put', 'b', {'id': 'b', 'loc': 'k2', '__id__': internal_id}),
+            ('del', 'a', None)])
+
+        LazyManager.refresh('t')
+        entries = LazyManager.records['t']
+        self.assertEqual(sorted(entries), [u'b', u'c'])
+        self.assertEqual(entries[u'b']['loc'], 'k2')
+        self.assertEqual(LazyManager.versions['t'], stamps[-1][0])
+        self.assertEqual(LazyManager.find_key('t', 'x3'), u'c')
+        self.assertEqual(LazyManager.field_indexes['t']['loc'].equal('k1'),
+                         set([u'c']))
+
+        etag = LazyManager.get_validators('t')[0]
+        self.assertTrue(etag.startswith(other.generation + '-'))
+        self.assertEqual(backend.generation, other.generation)
+
+    def test_reloads_after_changes_are_pruned(self):
+        self.init_shared()
+        self.add({'id': 'a', 'loc': 'k1'})
+
+        other = SqliteBackend(self.path('store.db'), keep_changes=5)
+        for i in range(1000):
+            self.write(other, [('put', 'p%d' % i,
+                                {'id': 'p%d' % i, '__id__': 'i%d' % i})])
+        self.assertEqual(other.changes('t', 1), None)
+
+        LazyManager.refresh('t')
+        self.assertEqual(len(LazyManager.records['t']), 1001)
+        self.assertEqual(len(LazyManager.id_indexes['t']), 1001)
+        self.assertEqual(LazyManager.versions['t'], other.version('t'))
+
+    def test_reloads_after_failed_write_block(self):
+        backend = self.init_shared()
+        self.add({'id': 'a', 'loc': 'k1'})
+
+        try:
+            with LazyManager.writing('t'):
+                LazyManager.records['t']['bogus'] = {'id': 'bogus'}
+                raise RuntimeError('failed')
+        except RuntimeError:
+            pass
+
+        self.assertEqual(backend.local.depth, 0)
+        LazyManager.refresh('t')
+        self.assertEqual(sorted(LazyManager.records['t']), [u'a'])
+
+        self.add({'id': 'b', 'loc': 'k1'})
+        self.assertEqual(sorted(backend.load(
+            LazyManager.collection_configs['t'])[0]), [u'a', u'b'])
+
+    def test_processes_share_writes(self):
+        self.init_shared()
+        client = self.client()
+
+        def insert(name):
+            for i in range(20):
+                self.client().post('/api/t', content_type='application/json',
+                    data=json.dumps({'id': '%s%d' % (name, i)}))
+            os._exit(0)
+
+        workers = [multiprocessing.Process(target=insert, args=(name,))
+                   for name in 'xyz']
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        response = client.get('/api/t')
+        self.assertEqual(len(json.loads(response.data)), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()